@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+
+import io, os, sys
+import asyncio
+import threading
+
+from ux.io import CountIO, read_file, split_lines
+
+
+class AsyncLineReader(object):
+    """Streams the lines of a file to an asyncio event loop.
+
+    Reading and decompression run in a worker thread that hands blocks of
+    whole lines to the loop, at most `queue_size` blocks ahead of the
+    consumer. Lines are split per block, so the loop is not woken up per
+    line. `counter` is the CountIO the blocks are read through, for
+    progress and size accounting; it is set once iteration starts.
+
+        async for line in aiter_lines(path):
+            ...
+    """
+
+    def __init__(self, path: str,
+                 block_size: int=1024 * 1024,
+                 queue_size: int=4,
+                 codec: Optional[str]='utf-8') -> None:
+        self.path = path
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.codec = codec
+
+        self.input_file = None  # type: Optional[IO[bytes]]
+        self.counter = None  # type: Optional[CountIO]
+
+        self.stopped = False
+        self.slots = threading.Semaphore(queue_size)
+
+    def _produce(self, loop: asyncio.AbstractEventLoop,
+                 queue: asyncio.Queue) -> None:
+        result = None  # type: Any
+        try:
+            while True:
+                self.slots.acquire()
+                if self.stopped:
+                    break
+
+                block = self.counter.readblock(self.block_size)
+                if len(block) == 0:
+                    break
+
+                loop.call_soon_threadsafe(queue.put_nowait, block)
+        except Exception as error:
+            result = error
+        finally:
+            self.input_file.close()
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, result)
+            except RuntimeError:
+                # The loop is already closed.
+                pass
+
+    def _split(self, block: bytes) -> List[Any]:
+        if self.codec is None:
+            return split_lines(block)
+        return split_lines(block.decode(self.codec))
+
+    async def batches(self) -> AsyncIterator[List[Any]]:
+        """Yields the lines of the file, one list per block.
+
+        The file is opened here and closed by the worker thread, so a reader
+        that is never iterated holds no handle.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()  # type: asyncio.Queue
+
+        self.stopped = False
+        self.slots = threading.Semaphore(self.queue_size)
+        self.input_file = read_file(self.path)
+        self.counter = CountIO(self.input_file)
+        worker = threading.Thread(target=self._produce, args=(loop, queue),
+                                  daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                block = await queue.get()
+                self.slots.release()
+
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+
+                yield self._split(block)
+        finally:
+            self.stopped = True
+            self.slots.release()
+
+    async def _lines(self) -> AsyncIterator[Any]:
+        batches = self.batches()
+        try:
+            async for lines in batches:
+                for line in lines:
+                    yield line
+        finally:
+            await batches.aclose()
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self._lines()
+
+
+def aiter_lines(path: str, **kwargs: Any) -> AsyncLineReader:
+    """Async iterator over the lines of a (possibly compressed) file."""
+    return AsyncLineReader(path, **kwargs)
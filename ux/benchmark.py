@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the readers, estimators and search of ux.io.
+
+    python -m ux.benchmark run --dir /tmp/ux-bench --sizes 16M,1G \\
+        --output results.json
+    python -m ux.benchmark compare baseline.json results.json
+"""
+
+from typing import *
+
+import io, os, sys
+import argparse
+import json
+import math
+import platform
+import random
+import time
+
+from ux import metrics
+from ux.cache import get_default_cache, set_default_cache
+from ux.compression import available_codecs, detect_codec, get_codec
+from ux.io import (BiReaderSearch, CountIO, estimate_compression_ratio,
+                   estimate_file_size, estimate_line_count,
+                   estimate_line_length, file_output, load_search_index,
+                   open_bireader, read_file)
+from ux.profiling import profile_stage, resource_usage
+
+
+KEY_WIDTH = 16
+ALPHABET = b'abcdefghijklmnopqrstuvwxyz0123456789 '
+
+
+def parse_size(text: str) -> int:
+    """Parses sizes such as '512K', '16M' or '20G'."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def corpus_name(size: int, lengths: str, sorted_keys: bool,
+                compression: str) -> str:
+    """`compression` is 'plain' or the name of a codec."""
+    return '%s-%s-%dM.txt%s' % (
+        lengths, 'sorted' if sorted_keys else 'random', size // 1024 ** 2,
+        '' if compression == 'plain' else
+        get_codec(compression).extensions[0])
+
+
+def _line_length(rng: random.Random, lengths: str, mean_length: int) -> int:
+    if lengths == 'fixed':
+        return mean_length
+    # Pareto with alpha = 1.5: the mean is finite, the variance is not.
+    alpha = 1.5
+    scale = mean_length * (alpha - 1) / alpha
+    return int(scale * rng.paretovariate(alpha))
+
+
+def generate_corpus(path: str, size: int,
+                    lengths: str='fixed',
+                    mean_length: int=80,
+                    sorted_keys: bool=False,
+                    seed: int=0,
+                    max_length: int=1024 * 1024) -> Dict[str, Any]:
+    """Writes about `size` bytes (uncompressed) of synthetic lines.
+
+    Every line starts with a zero-padded numeric key of KEY_WIDTH digits
+    and a tab, increasing with `sorted_keys` and random otherwise, padded
+    to a length that is either fixed or heavy-tailed (`lengths` is 'fixed'
+    or 'heavy'). The exact size and line count are stored in a sidecar
+    `.meta.json` and returned.
+    """
+    if lengths not in ('fixed', 'heavy'):
+        raise ValueError('Unknown line length distribution: %r' % (lengths,))
+
+    rng = random.Random(seed)
+    payload = bytes(rng.choice(ALPHABET) for _ in range(2 * max_length))
+    key_format = ('%%0%dd\t' % KEY_WIDTH).encode('ascii')
+    key_step = max(10 ** KEY_WIDTH // max(size // mean_length, 1), 1)
+
+    written = 0
+    lines = 0
+    key = 0
+    with file_output(path, mode='wb', compresslevel=6) as output_file:
+        while written < size:
+            chunk = []
+            for _ in range(10000):
+                if sorted_keys:
+                    key += rng.randrange(1, 2 * key_step)
+                else:
+                    key = rng.randrange(10 ** KEY_WIDTH)
+
+                length = min(_line_length(rng, lengths, mean_length),
+                             max_length)
+                length = max(length - KEY_WIDTH - 2, 0)
+                start = rng.randrange(max_length)
+                line = key_format % key + payload[start:start + length] + \
+                    b'\n'
+                chunk.append(line)
+                written += len(line)
+                lines += 1
+                if written >= size:
+                    break
+            output_file.write(b''.join(chunk))
+
+    meta = {'path': path, 'size': written, 'line_count': lines,
+            'lengths': lengths, 'mean_length': mean_length,
+            'sorted': sorted_keys, 'seed': seed}
+    with open(path + '.meta.json', 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return meta
+
+
+def load_corpus(path: str, size: int, **kwargs: Any) -> Dict[str, Any]:
+    """Returns the metadata of a corpus, generating it if needed."""
+    try:
+        with open(path + '.meta.json') as meta_file:
+            meta = json.load(meta_file)
+        if os.path.exists(path):
+            return meta
+    except (OSError, ValueError):
+        pass
+    return generate_corpus(path, size, **kwargs)
+
+
+def key_func(line: bytes) -> int:
+    return int(line[:KEY_WIDTH])
+
+
+class Measurement(object):
+    """Wall time, CPU, peak memory and metrics deltas around a block."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stage = profile_stage(name, quiet=True)
+        self.result = {}  # type: Dict[str, Any]
+
+    def __enter__(self) -> 'Measurement':
+        self.start_metrics = metrics.registry.collect()
+        self.stage.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.stage.__exit__(exc_type, exc_value, traceback)
+        wall = self.stage.end_clock - self.stage.start_clock
+        self.result.update({
+            'seconds': wall,
+            'cpu_seconds': self.stage.usage['cpu_user'] +
+            self.stage.usage['cpu_system'],
+            'peak_rss_mb': None if self.stage.peak_memory is None
+            else self.stage.peak_memory / 1024.0 ** 2,
+            'rss_delta_mb': self.stage.end_memory - self.stage.start_memory,
+        })
+        return False
+
+    @property
+    def seconds(self) -> float:
+        return self.result['seconds']
+
+    def metric(self, name: str, stream: str) -> float:
+        key = (name, (('stream', stream),))
+        return metrics.registry.collect().get(key, 0) - \
+            self.start_metrics.get(key, 0)
+
+
+def bench_countio(path: str, meta: Dict[str, Any],
+                  block_size: Optional[int]=None) -> Dict[str, Any]:
+    """Reads the whole file through CountIO, per line or per block."""
+    with Measurement('countio') as measurement:
+        with read_file(path) as input_file:
+            counter = CountIO(input_file)
+            lines = 0
+            if block_size is None:
+                for _ in counter:
+                    lines += 1
+            else:
+                while True:
+                    block = counter.readblock(block_size)
+                    if len(block) == 0:
+                        break
+                    lines += block.count(b'\n')
+            raw_bytes = counter.file_stats.compressed_read_count
+
+    result = measurement.result
+    result.update({
+        'block_size': block_size,
+        'lines': lines,
+        'lines_per_second': lines / measurement.seconds,
+        'mb_per_second': meta['size'] / 1024.0 ** 2 / measurement.seconds,
+        'raw_mb_per_second': raw_bytes / 1024.0 ** 2 / measurement.seconds,
+    })
+    return result
+
+
+def bench_bireader(path: str, meta: Dict[str, Any],
+                   reads: int=1000, seed: int=0) -> Dict[str, Any]:
+    """Reads the lines around random offsets, forwards and backwards."""
+    rng = random.Random(seed)
+    with open_bireader(path, use_mmap=False) as reader:
+        offsets = [rng.randrange(reader.size) for _ in range(reads)]
+        with Measurement('bireader') as measurement:
+            for offset in offsets:
+                reader.seek(offset)
+                reader.readlinel()
+                reader.readliner()
+                reader.readliner()
+
+    result = measurement.result
+    result.update({
+        'reads': reads,
+        'reads_per_second': reads / measurement.seconds,
+        'seeks_per_read': measurement.metric('ux_seeks_total',
+                                             'bireader') / reads,
+    })
+    return result
+
+
+def bench_search(path: str, meta: Dict[str, Any],
+                 method: str='binary', lookups: int=1000,
+                 seed: int=0) -> Dict[str, Any]:
+    """Looks up random keys in a sorted corpus with `method`, one of
+    'binary', 'interpolation', 'index' or 'batch' (galloping, which is
+    only used without an index)."""
+    rng = random.Random(seed)
+    with open_bireader(path, use_mmap=False) as reader:
+        index = load_search_index(path, key_func) \
+            if method == 'index' else None
+        search = BiReaderSearch(reader, key_func, index=index,
+                                key_to_number=float)
+        keys = [rng.randrange(search.first[1], search.last[1] + 1)
+                for _ in range(lookups)]
+
+        with Measurement('search') as measurement:
+            if method == 'batch':
+                for _ in search.lookup_many(sorted(keys)):
+                    pass
+            else:
+                lookup = search.interpolationr \
+                    if method == 'interpolation' else search.binaryr
+                for key in keys:
+                    lookup(key)
+
+    result = measurement.result
+    result.update({
+        'method': method,
+        'lookups': lookups,
+        'lookups_per_second': lookups / measurement.seconds,
+        'seeks_per_lookup': measurement.metric('ux_seeks_total',
+                                               'bireader') / lookups,
+    })
+    return result
+
+
+def bench_estimators(path: str, meta: Dict[str, Any],
+                     max_error: float=0.01,
+                     probability: float=0.99) -> List[Dict[str, Any]]:
+    """Runs every estimator and compares it with the true values."""
+    truth = {
+        'file_size': meta['size'],
+        'line_count': meta['line_count'],
+        'line_length': meta['size'] / max(meta['line_count'], 1),
+        'compression_ratio': os.path.getsize(path) / max(meta['size'], 1),
+    }
+    estimators = [
+        ('file_size', estimate_file_size, {}),
+        ('line_length', estimate_line_length, {}),
+        ('line_length', estimate_line_length, {'sampling': True}),
+        ('line_count', estimate_line_count, {}),
+        ('line_count', estimate_line_count, {'sampling': True}),
+    ]
+    if detect_codec(path) is not None:
+        estimators.append(('compression_ratio', estimate_compression_ratio,
+                           {}))
+
+    results = []
+    for name, estimator, kwargs in estimators:
+        with read_file(path) as input_file:
+            start = resource_usage().get('read_chars')
+            with Measurement('estimate_' + name) as measurement:
+                value = estimator(input_file, max_error, probability,
+                                  use_cache=False, **kwargs)
+            end = resource_usage().get('read_chars')
+
+        result = measurement.result
+        result.update({
+            'estimator': name,
+            'sampling': kwargs.get('sampling', False),
+            'max_error': max_error,
+            'value': value,
+            'true_value': truth[name],
+            'error': abs(value - truth[name]) / max(truth[name], 1e-9),
+            'bytes_read': None if start is None else end - start,
+        })
+        results.append(result)
+    return results
+
+
+def run_benchmarks(directory: str,
+                   sizes: Sequence[int]=(16 * 1024 ** 2,),
+                   lengths: Sequence[str]=('fixed', 'heavy'),
+                   compression: Sequence[str]=('plain', 'gzip'),
+                   lookups: int=1000) -> Dict[str, Any]:
+    """Generates (or reuses) the corpora in `directory` and benchmarks
+    them, returning the results with some context about the machine."""
+    results = []
+
+    def record(benchmark: str, corpus: str, result: Dict[str, Any]) -> None:
+        result = dict(result, benchmark=benchmark, corpus=corpus)
+        results.append(result)
+        print('%-12s %-28s %.3fs' % (benchmark, corpus, result['seconds']),
+              file=sys.stderr)
+
+    # Exact statistics cached by the full passes would answer the
+    # estimators, so the whole harness runs without the stats cache.
+    cache = get_default_cache()
+    set_default_cache(None)
+    try:
+        for size in sizes:
+            for line_lengths in lengths:
+                for kind in compression:
+                    for sorted_keys in (False, True):
+                        name = corpus_name(size, line_lengths, sorted_keys,
+                                           kind)
+                        path = os.path.join(directory, name)
+                        meta = load_corpus(path, size, lengths=line_lengths,
+                                           sorted_keys=sorted_keys)
+
+                        if sorted_keys:
+                            for method in ('binary', 'interpolation', 'index',
+                                           'batch'):
+                                record('search', name, bench_search(
+                                    path, meta, method, lookups))
+                            continue
+
+                        record('countio', name, bench_countio(path, meta))
+                        record('countio', name, bench_countio(
+                            path, meta, block_size=1024 * 1024))
+                        record('bireader', name, bench_bireader(path, meta))
+                        for result in bench_estimators(path, meta):
+                            record('estimator', name, result)
+    finally:
+        set_default_cache(cache)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+# Result fields compared across runs, with the direction of improvement.
+HIGHER_IS_BETTER = ['lines_per_second', 'mb_per_second', 'reads_per_second',
+                    'lookups_per_second']
+LOWER_IS_BETTER = ['seeks_per_lookup', 'seeks_per_read', 'error',
+                   'bytes_read', 'peak_rss_mb']
+
+
+def _result_key(result: Dict[str, Any]) -> Tuple:
+    return (result['benchmark'], result['corpus'],
+            result.get('block_size'), result.get('method'),
+            result.get('estimator'), result.get('sampling'))
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            threshold: float=0.1) -> List[Dict[str, Any]]:
+    """Lists the fields that got worse by more than `threshold` (relative)
+    between two runs of the same benchmarks."""
+    baseline_results = {_result_key(result): result
+                        for result in baseline['results']}
+
+    regressions = []
+    for result in current['results']:
+        old = baseline_results.get(_result_key(result))
+        if old is None:
+            continue
+
+        for field in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            before, after = old.get(field), result.get(field)
+            if before is None or after is None or before == 0:
+                continue
+            change = (after - before) / abs(before)
+            if field in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append({
+                    'benchmark': result['benchmark'],
+                    'corpus': result['corpus'],
+                    'key': [value for value in _result_key(result)[2:]
+                            if value is not None],
+                    'field': field,
+                    'before': before,
+                    'after': after,
+                    'change': change,
+                })
+    return regressions
+
+
+def main(argv: Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m ux.benchmark')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--dir', default='ux-bench',
+                     help='directory of the generated corpora')
+    run.add_argument('--sizes', default='16M',
+                     help='comma separated corpus sizes, e.g. 16M,1G')
+    run.add_argument('--lengths', default='fixed,heavy')
+    run.add_argument('--compression', default='plain,gzip',
+                     help='comma separated list of plain and codecs: %s'
+                     % ', '.join(available_codecs()))
+    run.add_argument('--lookups', type=int, default=1000)
+    run.add_argument('--output', default='-')
+
+    compare_parser = commands.add_parser(
+        'compare', help='flag regressions between two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        os.makedirs(args.dir, exist_ok=True)
+        results = run_benchmarks(
+            args.dir,
+            sizes=[parse_size(size) for size in args.sizes.split(',')],
+            lengths=args.lengths.split(','),
+            compression=args.compression.split(','),
+            lookups=args.lookups)
+        if args.output == '-':
+            json.dump(results, sys.stdout, indent=2)
+        else:
+            with open(args.output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print('%(benchmark)s %(corpus)s %(key)s %(field)s: '
+                  '%(before).4g -> %(after).4g (%(change)+.1f%%)' %
+                  dict(regression, change=100 * regression['change']))
+        return 1 if regressions else 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
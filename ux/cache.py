@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+
+import io, os, sys
+import json
+import sqlite3
+import threading
+
+
+FileKey = Tuple[int, int, int, int]
+# A file key and the view of the file the statistics are about: 'plain'
+# for its raw bytes or the name of the codec that decompressed it.
+StatsKey = Tuple[int, int, int, int, str]
+
+
+def file_key(file: Union[int, str]) -> FileKey:
+    """Identity of an immutable file: (device, inode, size, mtime).
+
+    `file` is either a file descriptor or a path.
+    """
+    stat = os.fstat(file) if isinstance(file, int) else os.stat(file)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def default_cache_path() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    return os.path.join(cache_home, 'ux', 'file_stats.sqlite')
+
+
+class FileStatsCache(object):
+    """On-disk cache of file statistics keyed by file identity and view.
+
+    Every entry records the error bound and the probability it was
+    estimated with; exact values are stored with a zero error and satisfy
+    any query. The cache is best effort, database errors are ignored.
+    """
+
+    def __init__(self, path: Optional[str]=None) -> None:
+        self.path = default_cache_path() if path is None else path
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS file_stats ('
+                ' device INTEGER, inode INTEGER, size INTEGER,'
+                ' mtime INTEGER, view TEXT, name TEXT, value TEXT,'
+                ' max_error REAL, probability REAL,'
+                ' PRIMARY KEY (device, inode, size, mtime, view, name))')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key: StatsKey, name: str,
+            max_error: float=0.0, probability: float=1.0) -> Optional[Any]:
+        """Returns a value at least as accurate as requested, or None."""
+        try:
+            row = self.connection.execute(
+                'SELECT value, max_error, probability FROM file_stats'
+                ' WHERE device = ? AND inode = ? AND size = ? AND mtime = ?'
+                ' AND view = ? AND name = ?', tuple(key) + (name,)
+            ).fetchone()
+        except (OSError, sqlite3.Error):
+            return None
+
+        if row is None:
+            return None
+
+        value, cached_error, cached_probability = row
+        if cached_error > max_error or \
+                (cached_error > 0 and cached_probability < probability):
+            return None
+        return json.loads(value)
+
+    def put(self, key: StatsKey, name: str, value: Any,
+            max_error: float=0.0, probability: float=1.0) -> None:
+        """Stores a value unless a more accurate one is already cached."""
+        if self.get(key, name, max_error, probability) is not None:
+            return
+
+        try:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO file_stats VALUES'
+                    ' (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    tuple(key) + (name, json.dumps(value),
+                                  max_error, probability))
+        except (OSError, sqlite3.Error):
+            pass
+
+
+_default_cache = None  # type: Optional[FileStatsCache]
+_default_cache_set = False
+
+
+def get_default_cache() -> Optional[FileStatsCache]:
+    """Returns the process-wide cache, None if disabled.
+
+    The cache is off unless enabled with `set_default_cache` or the
+    UX_STATS_CACHE environment variable, which names the database ('default'
+    for ~/.cache/ux/file_stats.sqlite). Once enabled, estimators and full
+    CountIO passes write to it.
+    """
+    global _default_cache, _default_cache_set
+
+    if not _default_cache_set:
+        path = os.environ.get('UX_STATS_CACHE', '')
+        if path != '':
+            _default_cache = FileStatsCache(
+                None if path == 'default' else path)
+        _default_cache_set = True
+    return _default_cache
+
+
+def set_default_cache(cache: Optional[FileStatsCache]) -> None:
+    global _default_cache, _default_cache_set
+
+    _default_cache = cache
+    _default_cache_set = True
@@ -4,10 +4,13 @@
 from typing import *
 
 import codecs
+import multiprocessing
 
 from clint.textui import progress
 
-from ux.io import CountIO, read_file
+from ux.io import (CountIO, count_lines, estimate_file_size, is_compressed,
+                   line_aligned_ranges, read_file, split_lines)
+from ux.progress import ProgressMeter
 
 
 def enumerate_lines_with_progressbar(path: str,
@@ -16,28 +19,41 @@ def enumerate_lines_with_progressbar(path: str,
                                      width: int=32, hide=None,
                                      every: int=100,
                                      codec: str ='utf-8',
-                                     skip_empty: bool=False
+                                     skip_empty: bool=False,
+                                     exact: bool=False,
+                                     batch_size: Optional[int]=None
                                      ) -> None:
     if label is None:
         label = path
 
+    if batch_size is not None:
+        batches = enumerate_line_batches_with_progressbar(
+            path, label=label, limit=limit, width=width, hide=hide,
+            codec=codec, exact=exact, batch_size=batch_size)
+        for start, lines in batches:
+            for i, line in enumerate(lines, start):
+                if skip_empty and line.strip() == '':
+                    continue
+                yield i, line
+        return
+
+    # With `exact`, lines are counted upfront instead of estimated.
+    total = count_lines(path) if exact else None
+
     input_file = read_file(path)
     counter = CountIO(input_file)
     reader = codecs.iterdecode(counter, codec) \
         if codec is not None else counter
 
-    with progress.Bar(label=label, width=width, hide=hide, every=every,
-                      expected_size=counter.line_count) as bar:
+    with _line_meter(counter, label, width, hide, limit, total) as meter:
+        count = 0
         for i, line in enumerate(reader):
             if i == limit:
                 break
 
-            if limit is None:
-                cnt = counter.line_count
-            else:
-                cnt = min(limit, counter.line_count)
-
-            bar.show(i + 1, cnt)
+            count = i + 1
+            if i % every == 0:
+                _update_line_meter(meter, counter, i)
 
             if skip_empty:
                 if line.strip() == '':
@@ -45,6 +61,79 @@ def enumerate_lines_with_progressbar(path: str,
 
             yield i, line
 
+        _update_line_meter(meter, counter, count)
+
+    input_file.close()
+
+
+def _line_meter(counter: CountIO, label: str, width: int, hide,
+                limit: Optional[int], total: Optional[int]
+                ) -> ProgressMeter:
+    """Progress in compressed bytes read, or in lines with a limit."""
+    if limit is not None:
+        return ProgressMeter(limit if total is None else min(limit, total),
+                             label=label, unit='lines', total_lines=total,
+                             width=width, hide=hide)
+
+    return ProgressMeter(counter.file_stats.underlying_file_size,
+                         label=label, unit='bytes', total_lines=total,
+                         width=width, hide=hide)
+
+
+def _update_line_meter(meter: ProgressMeter, counter: CountIO,
+                       lines: int) -> None:
+    if meter.unit == 'lines':
+        meter.update(lines, lines)
+    else:
+        meter.update(counter.file_stats.compressed_read_count, lines)
+
+
+def enumerate_line_batches_with_progressbar(path: str,
+                                            label: str='',
+                                            limit: Optional[int]=None,
+                                            width: int=32, hide=None,
+                                            codec: str='utf-8',
+                                            skip_empty: bool=False,
+                                            exact: bool=False,
+                                            batch_size: int=4 * 1024 * 1024
+                                            ) -> Iterator[Tuple[int, List]]:
+    """Yields (start_index, lines) for blocks of about `batch_size` bytes.
+
+    Each block is decoded once and split on newlines, and the progress is
+    updated once per block. With `skip_empty`, empty lines are dropped
+    from the batches, `start_index` is still the index of the first line
+    of the block in the file.
+    """
+    if label is None:
+        label = path
+
+    total = count_lines(path) if exact else None
+
+    input_file = read_file(path)
+    counter = CountIO(input_file)
+    decoder = codecs.getincrementaldecoder(codec)() \
+        if codec is not None else None
+
+    with _line_meter(counter, label, width, hide, limit, total) as meter:
+        start = 0
+        while limit is None or start < limit:
+            block = counter.readblock(batch_size)
+            if len(block) == 0:
+                break
+
+            lines = split_lines(decoder.decode(block)
+                                if decoder is not None else block)
+            if limit is not None:
+                lines = lines[:limit - start]
+
+            index = start
+            start += len(lines)
+            _update_line_meter(meter, counter, start)
+
+            if skip_empty:
+                lines = [line for line in lines if line.strip() != '']
+            yield index, lines
+
     input_file.close()
 
 
@@ -58,3 +147,123 @@ def enumerate_with_progressbar(lst, label='',
         for i, item in enumerate(lst):
             bar.show(i + 1, total)
             yield i, item
+
+
+# Byte counter shared with the worker processes of parallel_map_lines.
+_bytes_done = None
+
+
+def _init_map_worker(bytes_done) -> None:
+    global _bytes_done
+    _bytes_done = bytes_done
+
+
+def _report_bytes(count: int) -> None:
+    with _bytes_done.get_lock():
+        _bytes_done.value += count
+
+
+def _map_line_range(args) -> List[Any]:
+    path, start, end, fn, codec, block_size = args
+
+    results = []
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        remaining = end - start
+        tail = b''
+
+        while remaining > 0:
+            block = input_file.read(min(block_size, remaining))
+            if len(block) == 0:
+                break
+            remaining -= len(block)
+
+            lines = (tail + block).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                line += b'\n'
+                results.append(fn(line.decode(codec)
+                                  if codec is not None else line))
+            _report_bytes(len(block))
+
+        if len(tail) > 0:
+            results.append(fn(tail.decode(codec)
+                              if codec is not None else tail))
+
+    return results
+
+
+def _map_line_batch(args) -> List[Any]:
+    lines, fn, codec = args
+
+    results = [fn(line.decode(codec) if codec is not None else line)
+               for line in lines]
+    _report_bytes(sum(len(line) for line in lines))
+    return results
+
+
+def _line_batches(path: str, fn, codec: Optional[str], batch_size: int):
+    with read_file(path) as input_file:
+        while True:
+            lines = input_file.readlines(batch_size)
+            if len(lines) == 0:
+                break
+            yield lines, fn, codec
+
+
+def parallel_map_lines(path: str,
+                       fn: Callable[[Any], Any],
+                       workers: Optional[int]=None,
+                       ordered: bool=True,
+                       label: str='',
+                       width: int=32, hide=None,
+                       codec: str='utf-8',
+                       chunk_size: int=8 * 1024 * 1024,
+                       block_size: int=1024 * 1024
+                       ) -> Iterator[Any]:
+    """Applies `fn` to every line of a file in a process pool.
+
+    Uncompressed files are split into newline-aligned byte ranges that the
+    workers read themselves; compressed files are decompressed here and
+    handed out as batches of lines. `fn` has to be picklable. Results are
+    yielded in file order unless `ordered` is False.
+    """
+    if label is None:
+        label = path
+
+    bytes_done = multiprocessing.Value('q', 0)
+
+    with read_file(path) as input_file:
+        compressed = is_compressed(input_file)
+        expected_size = estimate_file_size(input_file)
+
+    if compressed:
+        tasks = _line_batches(path, fn, codec, chunk_size)
+        worker = _map_line_batch
+    else:
+        tasks = ((path, start, end, fn, codec, block_size)
+                 for start, end in line_aligned_ranges(path, chunk_size))
+        worker = _map_line_range
+
+    with multiprocessing.Pool(workers, initializer=_init_map_worker,
+                              initargs=(bytes_done,)) as pool, \
+            ProgressMeter(expected_size, label=label,
+                          width=width, hide=hide) as meter:
+        if ordered:
+            results = pool.imap(worker, tasks)
+        else:
+            results = pool.imap_unordered(worker, tasks)
+
+        lines = 0
+        while True:
+            try:
+                batch = results.next(timeout=0.1)
+            except multiprocessing.TimeoutError:
+                meter.update(bytes_done.value)
+                continue
+            except StopIteration:
+                break
+
+            lines += len(batch)
+            meter.update(bytes_done.value, lines)
+            yield from batch
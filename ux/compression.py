@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+from typing import IO
+
+import io, os, sys
+import bz2
+import collections
+import gzip
+import lzma
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from namedlist import namedlist
+
+from ux.gz import ParallelGzipReader, SeekableGzipFile
+
+
+# `open(file_object, mode, level, threads)` wraps an open binary file in a
+# (de)compressing file object. `magic` is the prefix of the files it
+# reads, or a tuple of prefixes. `types` are the classes of the file
+# objects it returns, `level` is the default compression level.
+Codec = namedlist(
+    'Codec',
+    ['name',
+     'extensions',
+     'magic',
+     'open',
+     'types',
+     'level'])
+
+MAGIC_SIZE = 10
+
+_codecs = collections.OrderedDict()  # type: Dict[str, Codec]
+
+
+def register_codec(codec: Codec) -> None:
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable codec: %r' % (name,))
+
+
+def available_codecs() -> List[str]:
+    return list(_codecs)
+
+
+def compressed_types() -> Tuple[type, ...]:
+    """Classes of all the decompressing file objects, which expose the
+    compressed file as `myfileobj`."""
+    return tuple(cls for codec in _codecs.values() for cls in codec.types)
+
+
+def codec_for_path(path: str) -> Optional[Codec]:
+    """The codec matching the extension of `path`, if any."""
+    ext = os.path.splitext(path)[1].lower()
+    for codec in _codecs.values():
+        if ext in codec.extensions:
+            return codec
+    return None
+
+
+def detect_codec(path: str) -> Optional[Codec]:
+    """The codec of a file by its magic bytes, None for plain files.
+
+    Falls back to the extension for files that can't be peeked at
+    without consuming them (pipes and other special files).
+    """
+    if not os.path.isfile(path):
+        return codec_for_path(path)
+
+    with open(path, 'rb') as input_file:
+        magic = input_file.read(MAGIC_SIZE)
+    for codec in _codecs.values():
+        if magic.startswith(codec.magic):
+            return codec
+    return None
+
+
+def open_codec(codec: Codec, file_object: IO[bytes], mode: str='rb',
+               level: Optional[int]=None,
+               threads: Optional[int]=None) -> IO[bytes]:
+    """Wraps `file_object` in a binary (de)compressing file object. The
+    result owns `file_object`: it is exposed as `myfileobj` and closed with
+    it."""
+    if level is None:
+        level = codec.level
+    try:
+        return codec.open(file_object, mode, level, threads)
+    except:
+        file_object.close()
+        raise
+
+
+class _ClosesFileObject(object):
+    """Closes `myfileobj` after the compressed stream, like GzipFile."""
+
+    myfileobj = None  # type: Optional[IO[bytes]]
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            file_object, self.myfileobj = self.myfileobj, None
+            if file_object is not None:
+                file_object.close()
+
+
+def _open_gzip(file_object: IO[bytes], mode: str, level: int,
+               threads: Optional[int]) -> IO[bytes]:
+    gzip_file = gzip.GzipFile(fileobj=file_object, mode=mode,
+                              compresslevel=level)
+    gzip_file.myfileobj = file_object
+    return gzip_file
+
+
+class Bz2File(_ClosesFileObject, bz2.BZ2File):
+    pass
+
+
+def _open_bz2(file_object: IO[bytes], mode: str, level: int,
+              threads: Optional[int]) -> IO[bytes]:
+    bz2_file = Bz2File(file_object, mode, compresslevel=level)
+    bz2_file.myfileobj = file_object
+    return bz2_file
+
+
+class LzmaFile(_ClosesFileObject, lzma.LZMAFile):
+    pass
+
+
+def _open_xz(file_object: IO[bytes], mode: str, level: int,
+             threads: Optional[int]) -> IO[bytes]:
+    if 'r' in mode:
+        # Also reads the legacy .lzma format.
+        lzma_file = LzmaFile(file_object, mode)
+    else:
+        lzma_file = LzmaFile(file_object, mode, preset=level)
+    lzma_file.myfileobj = file_object
+    return lzma_file
+
+
+register_codec(Codec(
+    name='gzip', extensions=['.gz'], magic=b'\x1f\x8b', open=_open_gzip,
+    types=[gzip.GzipFile, SeekableGzipFile, ParallelGzipReader], level=9))
+# 'BZh', the block size and the magic of either the first block or the
+# end of stream: 'BZh' alone is common at the start of text.
+register_codec(Codec(
+    name='bz2', extensions=['.bz2'],
+    magic=tuple(b'BZh%d%s' % (block_size, block_magic)
+                for block_size in range(1, 10)
+                for block_magic in (b'1AY&SY', b'\x17rE8P\x90')),
+    open=_open_bz2, types=[Bz2File], level=9))
+register_codec(Codec(
+    name='xz', extensions=['.xz', '.lzma'], magic=b'\xfd7zXZ\x00',
+    open=_open_xz, types=[LzmaFile], level=6))
+
+
+if zstd is not None:
+    class ZstdFile(_ClosesFileObject, zstd.ZstdFile):
+        pass
+
+    def _open_zstd(file_object: IO[bytes], mode: str, level: int,
+                   threads: Optional[int]) -> IO[bytes]:
+        if 'r' in mode:
+            zstd_file = ZstdFile(file_object, mode)
+        else:
+            options = {zstd.CompressionParameter.compression_level: level}
+            if threads is None or threads > 1:
+                options[zstd.CompressionParameter.nb_workers] = \
+                    threads or os.cpu_count() or 1
+            zstd_file = ZstdFile(file_object, mode, options=options)
+        zstd_file.myfileobj = file_object
+        return zstd_file
+
+    register_codec(Codec(
+        name='zstd', extensions=['.zst', '.zstd'], magic=b'(\xb5/\xfd',
+        open=_open_zstd, types=[ZstdFile], level=3))
+
+elif zstandard is not None:
+    class _ZstdRawReader(io.RawIOBase):
+        """A zstandard decompression stream, seekable like BZ2File: seeking
+        backwards restarts decompression from the beginning."""
+
+        def __init__(self, file_object: IO[bytes]) -> None:
+            self.file_object = file_object
+            self.start = file_object.tell()
+            self._restart()
+
+        def _restart(self) -> None:
+            self.file_object.seek(self.start)
+            self.stream = zstandard.ZstdDecompressor().stream_reader(
+                self.file_object, read_across_frames=True, closefd=False)
+            self.position = 0
+
+        def readable(self) -> bool:
+            return True
+
+        def seekable(self) -> bool:
+            return True
+
+        def readinto(self, buffer: Any) -> int:
+            count = self.stream.readinto(buffer)
+            self.position += count
+            return count
+
+        def tell(self) -> int:
+            return self.position
+
+        def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+            if whence == io.SEEK_CUR:
+                offset += self.position
+            elif whence == io.SEEK_END:
+                while self.read(io.DEFAULT_BUFFER_SIZE):
+                    pass
+                offset += self.position
+            if offset < self.position:
+                self._restart()
+            while self.position < offset:
+                if not self.read(min(offset - self.position,
+                                     io.DEFAULT_BUFFER_SIZE)):
+                    break
+            return self.position
+
+        def close(self) -> None:
+            if not self.closed:
+                self.stream.close()
+            super().close()
+
+    class ZstdReader(_ClosesFileObject, io.BufferedReader):
+        """Buffered reader over a zstandard decompression stream."""
+
+        def __init__(self, file_object: IO[bytes]) -> None:
+            super().__init__(_ZstdRawReader(file_object))
+            self.myfileobj = file_object
+
+    class ZstdWriter(_ClosesFileObject, io.BufferedWriter):
+        """Buffered writer over a zstandard compression stream."""
+
+        def __init__(self, file_object: IO[bytes], level: int,
+                     threads: Optional[int]) -> None:
+            # zstandard counts worker threads, -1 is one per CPU.
+            workers = -1 if threads is None else \
+                (0 if threads <= 1 else threads)
+            compressor = zstandard.ZstdCompressor(level=level,
+                                                  threads=workers)
+            super().__init__(compressor.stream_writer(file_object,
+                                                      closefd=False))
+            self.myfileobj = file_object
+
+    def _open_zstd(file_object: IO[bytes], mode: str, level: int,
+                   threads: Optional[int]) -> IO[bytes]:
+        if 'r' in mode:
+            return ZstdReader(file_object)
+        return ZstdWriter(file_object, level, threads)
+
+    register_codec(Codec(
+        name='zstd', extensions=['.zst', '.zstd'], magic=b'(\xb5/\xfd',
+        open=_open_zstd, types=[ZstdReader], level=3))
@@ -0,0 +1,645 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+from typing import IO
+
+import io, os, sys
+import bisect
+import collections
+import struct
+import time
+import zlib
+
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from namedlist import namedlist
+
+from ux.metrics import StreamMetrics
+
+
+GZIP_INDEX_MAGIC = b'UXGZIDX\x00'
+GZIP_INDEX_VERSION = 2
+
+# Sidecar index header: magic, version, size and mtime of the gzip file,
+# uncompressed size (-1 if unknown) and the number of members. It is
+# followed by the (offset, compressed_offset) pairs of the member
+# boundaries as little-endian int64.
+_GZIP_INDEX_HEADER = struct.Struct('<8sIqqqq')
+
+# Decompressor checkpoint: `decompressor` is a copy of the zlib state after
+# `offset` bytes were produced and `compressed_offset` bytes were consumed,
+# or None at the beginning of a gzip member.
+Checkpoint = namedlist(
+    'Checkpoint',
+    ['offset', 'compressed_offset', 'decompressor'])
+
+
+def gzip_index_path(path: str) -> str:
+    """Returns the path of the sidecar checkpoint file for `path`."""
+    return path + '.gzidx'
+
+
+class _BlockReader(io.BufferedIOBase):
+    """Buffered reading over blocks produced by `_fill`.
+
+    Subclasses implement `_fill`, which makes sure the unread data
+    `_buffer[_buffer_pos:]` is not empty, returning False at the end of
+    file; `_pos` is the position of the next byte to be read.
+    """
+
+    _buffer = b''
+    _buffer_pos = 0
+    _pos = 0
+
+    def _available(self) -> int:
+        return len(self._buffer) - self._buffer_pos
+
+    def _consume(self, length: int) -> bytes:
+        data = self._buffer[self._buffer_pos:self._buffer_pos + length]
+        self._buffer_pos += len(data)
+        self._pos += len(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        if size is None or size < 0:
+            chunks = []
+            while self._fill():
+                chunks.append(self._consume(self._available()))
+            return b''.join(chunks)
+
+        if size <= self._available():
+            return self._consume(size)
+
+        chunks = []
+        while size > 0 and self._fill():
+            chunk = self._consume(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read1(self, size: int=-1) -> bytes:
+        if not self._fill():
+            return b''
+        if size is None or size < 0:
+            size = self._available()
+        return self._consume(size)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def peek(self, size: int=0) -> bytes:
+        if not self._fill():
+            return b''
+        return self._buffer[self._buffer_pos:]
+
+    def readline(self, size: Optional[int]=-1) -> bytes:
+        if size is None:
+            size = -1
+
+        chunks = []
+        while size != 0 and self._fill():
+            end = self._buffer.find(b'\n', self._buffer_pos)
+            length = self._available() if end == -1 \
+                else end + 1 - self._buffer_pos
+            if size > 0:
+                length = min(length, size)
+                size -= length
+            chunks.append(self._consume(length))
+            if end != -1 and self._buffer_pos == end + 1:
+                break
+        return b''.join(chunks)
+
+
+class SeekableGzipFile(_BlockReader):
+    """Random-access reader for gzip files.
+
+    While reading, a checkpoint of the decompressor is recorded every
+    `spacing` uncompressed bytes and at every gzip member boundary, so a
+    seek to any offset decompresses at most one checkpoint interval.
+
+    zlib does not expose the bit offset of deflate blocks, so in-memory
+    checkpoints can't be persisted. The sidecar index stores the member
+    boundaries and the uncompressed size, which makes multi-member files
+    (pigz --independent, bgzip, `ux.io.file_output(threads=N)`) seekable
+    without a full pass. An existing index is always used; it is only
+    written after a full pass with `save_index`.
+    """
+
+    def __init__(self, path: str,
+                 spacing: int=4 * 1024 * 1024,
+                 read_size: int=64 * 1024,
+                 index_path: Optional[str]=None,
+                 save_index: bool=False) -> None:
+        self.name = path
+        self.myfileobj = open(path, 'rb')
+        self.spacing = spacing
+        self.read_size = read_size
+        self.index_path = gzip_index_path(path) \
+            if index_path is None else index_path
+        self.save_index = save_index
+
+        self.checkpoints = []  # type: List[Checkpoint]
+        self.offsets = []  # type: List[int]
+        self._size = None  # type: Optional[int]
+
+        if not self._load_index():
+            self._add_checkpoint(0, 0, None)
+
+        self._restore(self.checkpoints[0])
+
+    # Index.
+
+    def _stat_key(self) -> Tuple[int, int]:
+        stat = os.fstat(self.myfileobj.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load_index(self) -> bool:
+        try:
+            with open(self.index_path, 'rb') as input_file:
+                magic, version, file_size, file_mtime, size, count = \
+                    _GZIP_INDEX_HEADER.unpack(
+                        input_file.read(_GZIP_INDEX_HEADER.size))
+                if magic != GZIP_INDEX_MAGIC or \
+                        version != GZIP_INDEX_VERSION or \
+                        (file_size, file_mtime) != self._stat_key():
+                    return False
+                members = array('q')
+                members.fromfile(input_file, 2 * count)
+        except (OSError, EOFError, ValueError, struct.error):
+            return False
+
+        if sys.byteorder == 'big':
+            members.byteswap()
+        for i in range(0, len(members), 2):
+            self._add_checkpoint(members[i], members[i + 1], None)
+        self._size = None if size < 0 else size
+        return len(self.checkpoints) > 0
+
+    def _write_index(self) -> None:
+        if not self.save_index:
+            return
+
+        members = array('q')
+        for checkpoint in self.checkpoints:
+            if checkpoint.decompressor is None:
+                members.append(checkpoint.offset)
+                members.append(checkpoint.compressed_offset)
+        if sys.byteorder == 'big':
+            members.byteswap()
+
+        file_size, file_mtime = self._stat_key()
+        try:
+            with open(self.index_path, 'wb') as output_file:
+                output_file.write(_GZIP_INDEX_HEADER.pack(
+                    GZIP_INDEX_MAGIC, GZIP_INDEX_VERSION, file_size,
+                    file_mtime, -1 if self._size is None else self._size,
+                    len(members) // 2))
+                members.tofile(output_file)
+        except OSError:
+            # Read-only location, checkpoints are still kept in memory.
+            pass
+
+    def _add_checkpoint(self, offset, compressed_offset, decompressor):
+        i = bisect.bisect_right(self.offsets, offset)
+        if i > 0:
+            previous = self.checkpoints[i - 1]
+            if previous.offset == offset:
+                # Member boundaries are preferred, they are cheaper.
+                if decompressor is None:
+                    previous.compressed_offset = compressed_offset
+                    previous.decompressor = None
+                return
+            if decompressor is not None and \
+                    offset - previous.offset < self.spacing:
+                return
+
+        self.offsets.insert(i, offset)
+        self.checkpoints.insert(i, Checkpoint(
+            offset=offset,
+            compressed_offset=compressed_offset,
+            decompressor=decompressor))
+
+    def _needs_checkpoint(self, offset: int) -> bool:
+        i = bisect.bisect_right(self.offsets, offset)
+        return offset - self.offsets[i - 1] >= self.spacing
+
+    @property
+    def compressed_size(self) -> int:
+        return os.fstat(self.myfileobj.fileno()).st_size
+
+    @property
+    def indexed_size(self) -> Optional[int]:
+        """Uncompressed size if it is known without a full pass."""
+        return self._size
+
+    @property
+    def size(self) -> int:
+        """Uncompressed size, requires a full pass unless indexed."""
+        if self._size is None:
+            pos = self._pos
+            self._restore(self.checkpoints[-1])
+            while self._decompress_block():
+                self._pos += len(self._buffer)
+                self._buffer, self._buffer_pos = b'', 0
+            self.seek(pos)
+        return self._size
+
+    def build_index(self) -> None:
+        """Makes a full pass over the file recording all checkpoints."""
+        self.size
+
+    # Decompression.
+
+    def _restore(self, checkpoint: Checkpoint) -> None:
+        self.myfileobj.seek(checkpoint.compressed_offset)
+        self._input = b''
+        self._input_pos = checkpoint.compressed_offset
+        self._decompressor = None if checkpoint.decompressor is None \
+            else checkpoint.decompressor.copy()
+        self._pos = checkpoint.offset
+        self._buffer = b''
+        self._buffer_pos = 0
+
+    def _decompress_block(self) -> bool:
+        """Decompresses the next block into the buffer.
+
+        Returns False at the end of file.
+        """
+        while True:
+            if len(self._input) == 0:
+                self._input = self.myfileobj.read(self.read_size)
+
+                if len(self._input) == 0:
+                    if self._decompressor is not None:
+                        raise EOFError("Compressed file ended before the "
+                                       "end-of-stream marker was reached")
+                    if self._size is None:
+                        self._size = self._pos
+                        self._write_index()
+                    return False
+
+            if self._decompressor is None:
+                # Members can be followed by zero padding.
+                data = self._input.lstrip(b'\x00')
+                self._input_pos += len(self._input) - len(data)
+                self._input = data
+                if len(self._input) == 0:
+                    continue
+
+                self._add_checkpoint(self._pos, self._input_pos, None)
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+            data = self._decompressor.decompress(self._input, self.read_size)
+            if self._decompressor.eof:
+                rest = self._decompressor.unused_data
+            else:
+                rest = self._decompressor.unconsumed_tail
+            self._input_pos += len(self._input) - len(rest)
+            self._input = rest
+
+            if self._decompressor.eof:
+                self._decompressor = None
+            elif self._needs_checkpoint(self._pos + len(data)):
+                # The remaining input is re-read from the file on restore.
+                self._add_checkpoint(self._pos + len(data), self._input_pos,
+                                     self._decompressor.copy())
+
+            if len(data) > 0:
+                self._buffer = data
+                self._buffer_pos = 0
+                return True
+
+    def _fill(self) -> bool:
+        if self._available() > 0:
+            return True
+        self._buffer, self._buffer_pos = b'', 0
+        return self._decompress_block()
+
+    # io.BufferedIOBase interface.
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.myfileobj.fileno()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.myfileobj.close()
+            self.checkpoints = []
+            self.offsets = []
+        super().close()
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence (%r)" % (whence,))
+
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % (offset,))
+
+        buffer_start = self._pos - self._buffer_pos
+        if buffer_start <= offset <= buffer_start + len(self._buffer):
+            self._buffer_pos = offset - buffer_start
+            self._pos = offset
+            return self._pos
+
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        checkpoint = self.checkpoints[i]
+        if not (checkpoint.offset <= self._pos <= offset):
+            self._restore(checkpoint)
+
+        while self._pos < offset and self._fill():
+            self._consume(offset - self._pos)
+        return self._pos
+
+
+# Extra field of the gzip members written by ParallelGzipWriter: subfield
+# 'UX' holds the compressed size of the member (uint32), in the spirit of
+# the 'BC' subfield of BGZF, which is understood as well.
+MEMBER_SIZE_SUBFIELD = b'UX'
+BGZF_SUBFIELD = b'BC'
+
+GZIP_HEADER_SIZE = 12
+
+
+def _pread_exactly(fd: int, size: int, offset: int) -> bytes:
+    data = os.pread(fd, size, offset)
+    while 0 < len(data) < size:
+        chunk = os.pread(fd, size - len(data), offset + len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return data
+
+
+def read_member_size(fd: int, offset: int) -> Optional[int]:
+    """Returns the compressed size of the gzip member at `offset` if it is
+    recorded in the header, or None."""
+    header = _pread_exactly(fd, GZIP_HEADER_SIZE, offset)
+    if len(header) < GZIP_HEADER_SIZE or header[:3] != b'\x1f\x8b\x08' \
+            or not header[3] & 0x04:
+        return None
+
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    extra = _pread_exactly(fd, xlen, offset + GZIP_HEADER_SIZE)
+
+    pos = 0
+    while pos + 4 <= len(extra):
+        subfield = extra[pos:pos + 2]
+        length = struct.unpack_from('<H', extra, pos + 2)[0]
+        data = extra[pos + 4:pos + 4 + length]
+        if subfield == MEMBER_SIZE_SUBFIELD and length == 4:
+            return struct.unpack('<I', data)[0]
+        elif subfield == BGZF_SUBFIELD and length == 2:
+            return struct.unpack('<H', data)[0] + 1
+        pos += 4 + length
+
+    return None
+
+
+def is_multi_member(path: str) -> bool:
+    """Checks whether the first gzip member records its size, which is the
+    case for files written by ParallelGzipWriter and bgzip."""
+    with open(path, 'rb') as input_file:
+        return read_member_size(input_file.fileno(), 0) is not None
+
+
+_writer_metrics = StreamMetrics('parallel_gzip_writer')
+_reader_metrics = StreamMetrics('parallel_gzip_reader')
+
+
+def _compress_member(data: bytes, level: int) -> bytes:
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+
+    size = GZIP_HEADER_SIZE + 8 + len(body) + 8
+    header = b'\x1f\x8b\x08\x04' + struct.pack(
+        '<IBBHccHI', 0, 0, 255, 8,
+        MEMBER_SIZE_SUBFIELD[:1], MEMBER_SIZE_SUBFIELD[1:], 4, size)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    _writer_metrics.compress_seconds.inc(time.perf_counter() - start)
+    return header + body + trailer
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """pigz-style gzip writer.
+
+    The stream is split into independent blocks that are compressed in a
+    thread pool (zlib releases the GIL) and written as consecutive gzip
+    members, which any gzip reader decompresses as a single stream.
+    """
+
+    def __init__(self, path: str, mode: str='wb',
+                 level: int=9,
+                 threads: Optional[int]=None,
+                 block_size: int=1024 * 1024) -> None:
+        self.name = path
+        self.myfileobj = open(path, mode[:1] + 'b')
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+
+        self._executor = ThreadPoolExecutor(self.threads)
+        self._pending = collections.deque()  # type: Deque[Future]
+        self._chunks = []  # type: List[bytes]
+        self._buffered = 0
+        self._members = 0
+
+    def readable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def fileno(self) -> int:
+        return self.myfileobj.fileno()
+
+    def _submit(self) -> None:
+        if self._buffered == 0 and self._members > 0:
+            return
+
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+
+        for start in range(0, max(len(data), 1), self.block_size):
+            self._members += 1
+            self._pending.append(self._executor.submit(
+                _compress_member, data[start:start + self.block_size],
+                self.level))
+
+            # Bounds the memory used by blocks waiting to be written.
+            while len(self._pending) > 2 * self.threads:
+                self._write_member()
+
+    def _write_member(self) -> None:
+        start = time.perf_counter()
+        member = self._pending.popleft().result()
+        _writer_metrics.wait_seconds.inc(time.perf_counter() - start)
+
+        self.myfileobj.write(member)
+        _writer_metrics.written_bytes.inc(len(member))
+
+    def _drain(self) -> None:
+        while len(self._pending) > 0:
+            self._write_member()
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+
+        data = bytes(data)
+        self._chunks.append(data)
+        self._buffered += len(data)
+
+        if self._buffered >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffered > 0:
+            self._submit()
+        self._drain()
+        self.myfileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            # An empty file still gets one member to be a valid gzip file.
+            self._submit()
+            super().close()
+        finally:
+            self._executor.shutdown()
+            self.myfileobj.close()
+
+
+class ParallelGzipReader(_BlockReader):
+    """Reader for gzip files whose members record their compressed size.
+
+    Members are read with pread and decompressed concurrently in a thread
+    pool, with at most `readahead` members in flight. The position of
+    `myfileobj` follows the member being consumed, so CountIO's compressed
+    byte accounting stays accurate.
+    """
+
+    def __init__(self, path: str,
+                 threads: Optional[int]=None,
+                 readahead: Optional[int]=None) -> None:
+        self.name = path
+        self.myfileobj = open(path, 'rb')
+        self.threads = threads or os.cpu_count() or 1
+        self.readahead = readahead or 2 * self.threads
+
+        self._fd = self.myfileobj.fileno()
+        self._compressed_size = os.fstat(self._fd).st_size
+        self._executor = ThreadPoolExecutor(self.threads)
+        self._rewind()
+
+    def _rewind(self) -> None:
+        self._pending = collections.deque()  # type: Deque[Tuple[int, Future]]
+        self._next_member = 0
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_pos = 0
+        self.myfileobj.seek(0)
+
+    def _decompress_member(self, offset: int, size: int) -> bytes:
+        data = _pread_exactly(self._fd, size, offset)
+        start = time.perf_counter()
+        result = []
+        while len(data) > 0:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            result.append(decompressor.decompress(data))
+            if not decompressor.eof:
+                raise EOFError("Compressed file ended before the "
+                               "end-of-stream marker was reached")
+            data = decompressor.unused_data.lstrip(b'\x00')
+        result = b''.join(result)
+
+        _reader_metrics.decompress_seconds.inc(time.perf_counter() - start)
+        _reader_metrics.record_read(size, len(result), 0, 0.0)
+        return result
+
+    def _schedule(self) -> None:
+        while len(self._pending) < self.readahead and \
+                self._next_member < self._compressed_size:
+            offset = self._next_member
+            size = read_member_size(self._fd, offset)
+            if size is None:
+                # Not written by us, decompress the rest in one go.
+                size = self._compressed_size - offset
+            self._next_member = offset + size
+            self._pending.append((
+                self._next_member,
+                self._executor.submit(self._decompress_member,
+                                      offset, size)))
+
+    def _fill(self) -> bool:
+        while self._buffer_pos >= len(self._buffer):
+            self._schedule()
+            if len(self._pending) == 0:
+                return False
+            end, future = self._pending.popleft()
+            start = time.perf_counter()
+            self._buffer = future.result()
+            _reader_metrics.wait_seconds.inc(time.perf_counter() - start)
+            self._buffer_pos = 0
+            self.myfileobj.seek(end)
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def close(self) -> None:
+        if not self.closed:
+            for _, future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+            self.myfileobj.close()
+        super().close()
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence == io.SEEK_END:
+            while self._fill():
+                self._consume(len(self._buffer))
+            offset = self._pos + offset
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence (%r)" % (whence,))
+
+        if offset < self._pos - self._buffer_pos:
+            self._rewind()
+        elif offset < self._pos:
+            self._pos -= self._buffer_pos
+            self._buffer_pos = 0
+
+        while self._pos < offset and self._fill():
+            self._consume(offset - self._pos)
+        return self._pos
@@ -2,16 +2,47 @@
 # -*- coding: utf-8 -*-
 
 from typing import *
-from typing.io import IO
+from typing import IO
 
 import io, os, sys
+import bisect
 import codecs
+import collections
 import gzip
+import heapq
+import json
 import math
 import errno
+import functools
+import mmap
+import operator
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from namedlist import namedlist
 
+from ux.cache import file_key, get_default_cache
+from ux.compression import (Codec, available_codecs, codec_for_path,
+                            compressed_types, detect_codec, get_codec,
+                            open_codec)
+from ux.gz import (ParallelGzipReader, ParallelGzipWriter, SeekableGzipFile,
+                   _BlockReader, is_multi_member)
+from ux.metrics import StreamMetrics
+from ux.progress import ProgressMeter
+
 def mkdir_p(path: str) -> None:
     try:
         os.makedirs(path)
@@ -21,26 +52,129 @@ def mkdir_p(path: str) -> None:
 
 
 def file_output(*pathparts: str, **kwargs: str) -> IO[Any]:
+    """Opens a file for writing, compressed according to its extension
+    or to the `codec` keyword (see ux.compression)."""
     mode     = kwargs.get('mode',     'wt+')
     encoding = kwargs.get('encoding', 'utf-8')
+    threads  = kwargs.get('threads',  None)
+    level    = kwargs.get('compresslevel', None)
+    codec    = kwargs.get('codec',    None)
+
+    if 'b' in mode:
+        encoding = None
 
     path = os.path.join(*pathparts)
     mkdir_p(os.path.dirname(path))
-    if os.path.splitext(path)[1] == '.gz':
-        return gzip.open(path, mode, encoding=encoding)
-    else:
-        return io.open(path, mode, encoding=encoding)
+    codec = codec_for_path(path) if codec is None else get_codec(codec)
+    if codec is None:
+        return _metered_open(path, mode, encoding, _file_output_metrics)
+
+    if codec.name == 'gzip' and threads != 1:
+        output_file = ParallelGzipWriter(
+            path, mode, level=codec.level if level is None else level,
+            threads=threads)
+        if 'b' in mode:
+            return output_file
+        return io.TextIOWrapper(output_file, encoding=encoding)
+
+    return _metered_codec(path, mode, encoding, codec, level, threads,
+                          _file_output_metrics)
 
 
 def file_input(*pathparts: str, **kwargs: str) -> IO[Any]:
     mode     = kwargs.get('mode',     'rt')
     encoding = kwargs.get('encoding', 'utf-8')
+    threads  = kwargs.get('threads',  None)
 
     path = os.path.join(*pathparts) # type: str
-    if os.path.splitext(path)[1] == '.gz':
-        return gzip.open(path, mode, encoding=encoding)
-    else:
-        return io.open(path, mode, encoding=encoding)
+    codec = detect_codec(path)
+    if codec is None:
+        return _metered_open(path, mode, encoding, _file_input_metrics)
+
+    if codec.name == 'gzip' and threads != 1 and is_multi_member(path):
+        input_file = ParallelGzipReader(path, threads=threads)
+        if 'b' in mode:
+            return input_file
+        return io.TextIOWrapper(input_file, encoding=encoding)
+
+    return _metered_codec(path, mode, encoding, codec, None, threads,
+                          _file_input_metrics)
+
+
+_file_input_metrics = StreamMetrics('file_input')
+_file_output_metrics = StreamMetrics('file_output')
+
+
+class MeteredFileIO(io.FileIO):
+    """A raw file reporting its reads, writes and seeks to `metrics`.
+
+    Only calls that reach the OS are counted, below the buffering.
+    """
+
+    def __init__(self, path: str, mode: str,
+                 metrics: StreamMetrics) -> None:
+        super().__init__(path, mode)
+        self.metrics = metrics
+
+    def readinto(self, buffer) -> Optional[int]:
+        start = time.perf_counter()
+        count = super().readinto(buffer)
+        self.metrics.record_read(count or 0, 0, 0,
+                                 time.perf_counter() - start)
+        return count
+
+    def readall(self) -> bytes:
+        start = time.perf_counter()
+        data = super().readall()
+        self.metrics.record_read(len(data), 0, 0,
+                                 time.perf_counter() - start)
+        return data
+
+    def write(self, data) -> Optional[int]:
+        count = super().write(data)
+        self.metrics.written_bytes.inc(count or 0)
+        return count
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        self.metrics.seeks.inc()
+        return super().seek(offset, whence)
+
+
+def _metered_binary(path: str, mode: str,
+                    metrics: StreamMetrics) -> IO[bytes]:
+    """Opens a buffered binary file the way `open` would."""
+    raw_mode = mode.replace('t', '').replace('b', '')
+    raw = MeteredFileIO(path, raw_mode, metrics)
+    if '+' in mode:
+        return io.BufferedRandom(raw)
+    if 'r' in mode:
+        return io.BufferedReader(raw)
+    return io.BufferedWriter(raw)
+
+
+def _metered_open(path: str, mode: str, encoding: Optional[str],
+                  metrics: StreamMetrics) -> IO[Any]:
+    binary_file = _metered_binary(path, mode, metrics)
+    if 'b' in mode:
+        return binary_file
+    return io.TextIOWrapper(binary_file, encoding=encoding)
+
+
+def _metered_codec(path: str, mode: str, encoding: Optional[str],
+                   codec: Codec, level: Optional[int],
+                   threads: Optional[int],
+                   metrics: StreamMetrics) -> IO[Any]:
+    binary_mode = mode.replace('t', '').replace('+', '')
+    binary_mode = binary_mode if 'b' in binary_mode else binary_mode + 'b'
+
+    # Closed with the compressed file, and found by get_file_object.
+    compressed_file = open_codec(
+        codec, _metered_binary(path, binary_mode, metrics), binary_mode,
+        level, threads)
+
+    if 'b' in mode:
+        return compressed_file
+    return io.TextIOWrapper(compressed_file, encoding=encoding)
 
 
 class SaveFilePos(object):
@@ -69,16 +203,50 @@ def file_size(file_handle: IO[Any], reset_pos: bool=True) -> int:
         return file_handle.tell()
 
 
+def is_compressed(file_handle: IO[Any]) -> bool:
+    if isinstance(file_handle, PrefetchReader):
+        return is_compressed(file_handle.base)
+    return isinstance(file_handle, compressed_types())
+
+
+def file_view(file_handle: IO[Any]) -> Optional[str]:
+    """What `file_handle` reads of its file: the name of the codec that
+    decompresses it, 'plain' for the raw bytes, or None if unknown (e.g.
+    a text wrapper)."""
+    if isinstance(file_handle, PrefetchReader):
+        return file_view(file_handle.base)
+    for name in available_codecs():
+        if isinstance(file_handle, tuple(get_codec(name).types)):
+            return name
+    if isinstance(file_handle, (io.FileIO, io.BufferedReader,
+                                io.BufferedRandom)):
+        return 'plain'
+    return None
+
+
 def get_file_object(file_handle: IO[Any]) -> IO[Any]:
-    """Returns the underlying file object."""
+    """Returns the underlying file object.
+
+    Every decompressing reader exposes it as `myfileobj`, and its position
+    is the number of compressed bytes consumed so far.
+    """
     while True:
-        if isinstance(file_handle, gzip.GzipFile):
+        if is_compressed(file_handle):
             file_handle = file_handle.myfileobj
         else:
             break
     return file_handle
 
 
+def underlying_file_size(file_handle: IO[Any]) -> int:
+    """Returns the size of the underlying file object."""
+    file_object = get_file_object(file_handle)
+    try:
+        return os.fstat(file_object.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return file_size(file_object)
+
+
 LineLengthStats = namedlist(
     'LineLengthStats',
     ['line_count', 'sum', 'sum_of_squares'])
@@ -90,6 +258,93 @@ FileStats = namedlist(
      'decompressed_read_count'])
 
 
+def stats_cache(file_handle: IO[Any]) -> Tuple[Any, Any]:
+    """Returns the default stats cache and the key of `file_handle`, or
+    (None, None) if there is no cache, the handle is not a real file or
+    its view of the file is unknown."""
+    cache = get_default_cache()
+    view = file_view(file_handle)
+    if cache is None or view is None:
+        return None, None
+
+    try:
+        return cache, \
+            file_key(get_file_object(file_handle).fileno()) + (view,)
+    except (AttributeError, OSError, ValueError):
+        return None, None
+
+
+def cached_estimate(name: str):
+    """Makes an estimator consult the stats cache before computing, and
+    store its result afterwards. Disabled by `use_cache=False`, which the
+    estimator receives to pass on to the estimators it calls."""
+    def decorator(estimator):
+        @functools.wraps(estimator)
+        def wrapper(input_file, max_error=0.01, probability=0.99,
+                    *args, use_cache=True, **kwargs):
+            cache, key = stats_cache(input_file) if use_cache \
+                else (None, None)
+            if cache is not None:
+                value = cache.get(key, name, max_error, probability)
+                if value is not None:
+                    return value
+
+            value = estimator(input_file, max_error, probability,
+                              *args, use_cache=use_cache, **kwargs)
+            if cache is not None:
+                cache.put(key, name, value, max_error, probability)
+            return value
+        return wrapper
+    return decorator
+
+
+def split_lines(data: AnyStr) -> List[AnyStr]:
+    """Splits text or bytes on newlines only, keeping them, the same way
+    iterating over a file does (unlike str.splitlines)."""
+    newline = b'\n' if isinstance(data, bytes) else '\n'
+
+    lines = data.split(newline)
+    last = lines.pop()
+    lines = [line + newline for line in lines]
+    if len(last) > 0:
+        lines.append(last)
+    return lines
+
+
+def chunk_line_stats(data: bytes, extra: int=0) -> Tuple[int, int, int, int]:
+    """Line statistics of a chunk.
+
+    Returns the number of complete lines, the sum and the sum of squares of
+    their lengths (without newlines), and the length of the incomplete
+    trailing line. `extra` is the length of the line continued by `data`.
+    """
+    count = data.count(b'\n')
+    if count == 0:
+        return 0, 0, 0, len(data)
+
+    last = data.rfind(b'\n')
+    tail = len(data) - last - 1
+    total = extra + last - (count - 1)
+
+    if count == 1:
+        return 1, total, total * total, tail
+
+    if np is not None and count >= 64:
+        newlines = np.flatnonzero(
+            np.frombuffer(data, dtype=np.uint8) == 10)
+        lengths = np.diff(newlines, prepend=-1) - 1
+        lengths[0] += extra
+        return count, total, int(np.dot(lengths, lengths)), tail
+
+    lengths = list(map(len, data.split(b'\n')))
+    lengths.pop()
+    lengths[0] += extra
+    return count, total, sum(map(operator.mul, lengths, lengths)), tail
+
+
+_countio_metrics = StreamMetrics('countio')
+
+
 class CountIO(io.IOBase):
     def __init__(self, base: IO[Any]) -> None:
         self.base = base
@@ -97,18 +352,28 @@ class CountIO(io.IOBase):
 
         self.last_line_extra = 0
 
+        # Exact statistics are cached when a full pass finishes.
+        self.from_start = base.tell() == 0
+        self.finished = False
+
         self.line_stats = LineLengthStats(
             line_count=0,
             sum=0,
             sum_of_squares=0)
 
         self.file_stats = FileStats(
-            is_compressed=isinstance(base, gzip.GzipFile),
-            underlying_file_size=file_size(self.base0),
+            is_compressed=is_compressed(base),
+            underlying_file_size=underlying_file_size(base),
             compressed_read_count=0,
             decompressed_read_count=0)
 
+        # Metrics are reported in batches, as deltas of the statistics.
+        self.read_calls = 0
+        self.read_seconds = 0.0
+        self.reported = (0, 0, 0, 0, 0.0)
+
     def close(self):
+        self.report_metrics()
         self.base.close()
 
     @property
@@ -139,47 +404,117 @@ class CountIO(io.IOBase):
         self.line_stats.sum_of_squares += length * length
         self.last_line_extra            = 0
 
-    def update_stats(self, real_read, data):
+    def update_stats(self, real_read, data, seconds=0.0):
         self.file_stats.compressed_read_count += real_read
 
+        self.read_calls += 1
+        self.read_seconds += seconds
+        if self.read_calls % 1024 == 0:
+            self.report_metrics()
+
         if data is not None:
             self.file_stats.decompressed_read_count += len(data)
 
-            last = None
-            while True:
-                newline = data.find(b'\n', last)
-
-                if last is None:
-                    last = -1
-
-                if newline == -1:
-                    self.last_line_extra += len(data) - (last + 1)
-                    break
-
-                length = self.last_line_extra + newline - (last + 1)
-                self.update_stats_line(length)
-                last = newline + 1
+            count, total, total_squares, tail = \
+                chunk_line_stats(data, self.last_line_extra)
+            if count == 0:
+                self.last_line_extra += tail
+                return
 
+            self.line_stats.line_count     += count
+            self.line_stats.sum            += total
+            self.line_stats.sum_of_squares += total_squares
+            self.last_line_extra            = tail
 
     def readline(self, limit=-1):
         pos0 = self.base0.tell()
+        start = time.perf_counter()
 
         result = None
         try:
             result = self.base.readline(limit)
             return result
         finally:
-            self.update_stats(self.base0.tell() - pos0, result)
+            self.update_stats(self.base0.tell() - pos0, result,
+                              time.perf_counter() - start)
+            if limit != 0 and result is not None and len(result) == 0:
+                self.finish()
 
     def read(self, limit=-1):
         pos0 = self.base0.tell()
+        start = time.perf_counter()
 
         result = None
         try:
             result = self.base.read(limit)
             return result
         finally:
-            self.update_stats(self.base0.tell() - pos0, result)
+            self.update_stats(self.base0.tell() - pos0, result,
+                              time.perf_counter() - start)
+            if limit != 0 and result is not None and len(result) == 0:
+                self.finish()
+
+    def readblock(self, size=1024 * 1024):
+        """Reads about `size` bytes extended to the end of a line, updating
+        the statistics once per block."""
+        pos0 = self.base0.tell()
+        start = time.perf_counter()
+
+        result = None
+        try:
+            result = self.base.read(size)
+            if len(result) > 0 and not result.endswith(b'\n'):
+                result += self.base.readline()
+            return result
+        finally:
+            self.update_stats(self.base0.tell() - pos0, result,
+                              time.perf_counter() - start)
+            if size != 0 and result is not None and len(result) == 0:
+                self.finish()
+
+    def readlines(self, hint=-1):
+        if hint is None or hint <= 0:
+            return split_lines(self.read())
+        return split_lines(self.readblock(hint))
+
+    def report_metrics(self):
+        """Adds the reads since the last report to the metrics registry."""
+        current = (self.read_calls,
+                   self.file_stats.compressed_read_count,
+                   self.file_stats.decompressed_read_count,
+                   self.line_stats.line_count,
+                   self.read_seconds)
+        calls, read_bytes, decompressed_bytes, lines, seconds = (
+            now - before for now, before in zip(current, self.reported))
+        self.reported = current
+        if calls > 0:
+            _countio_metrics.record_read(read_bytes, decompressed_bytes,
+                                         lines, seconds, calls)
+
+    def finish(self):
+        """Stores the exact statistics of a full pass in the stats cache."""
+        self.report_metrics()
+        if self.finished or not self.from_start:
+            return
+        self.finished = True
+
+        cache, key = stats_cache(self.base)
+        if cache is None:
+            return
+
+        size = self.file_stats.decompressed_read_count
+        line_count = self.line_stats.line_count + \
+            (1 if self.last_line_extra > 0 else 0)
+
+        cache.put(key, 'file_size', size)
+        cache.put(key, 'line_count', line_count)
+        if line_count > 0:
+            cache.put(key, 'line_length', size / line_count)
+        if self.file_stats.is_compressed and size > 0:
+            cache.put(key, 'compression_ratio',
+                      self.file_stats.compressed_read_count / size)
+        cache.put(key, 'line_stats', list(self.line_stats))
+        cache.put(key, 'file_stats', list(self.file_stats))
 
     @property
     def size(self):
@@ -187,40 +522,494 @@ class CountIO(io.IOBase):
             return self.file_stats.underlying_file_size
 
         if self.file_stats.compressed_read_count == 0:
-            return self.underlying_file_size
+            return self.file_stats.underlying_file_size
 
-        compression_ratio = self.file_stats.decompressed_read_count / \
+        # Integer arithmetic keeps the size exact after a full pass.
+        return self.file_stats.decompressed_read_count * \
+            self.file_stats.underlying_file_size // \
             self.file_stats.compressed_read_count
-        return int(compression_ratio * self.file_stats.underlying_file_size)
 
     @property
     def line_count(self):
         if self.line_stats.line_count == 0:
             return 1
 
-        line_length = self.line_stats.sum / self.line_stats.line_count
+        # Line stats don't count the newline characters.
+        line_length = self.line_stats.sum / self.line_stats.line_count + 1
         return self.size / line_length
 
 
-def read_file(path: str) -> IO[Any]:
-    _, ext = os.path.splitext(path)
+_prefetch_metrics = StreamMetrics('prefetch')
+
+
+class _ConsumedRawFile(object):
+    """The raw file of a compressed PrefetchReader, positioned after the
+    compressed data of the block being consumed rather than of the block
+    being prefetched."""
+
+    def __init__(self, reader: 'PrefetchReader') -> None:
+        self.reader = reader
+
+    def tell(self) -> int:
+        return self.reader.raw_position
+
+    def fileno(self) -> int:
+        return self.reader.raw.fileno()
+
+
+class PrefetchReader(_BlockReader):
+    """Reads ahead of the consumer in a background thread.
+
+    Up to `prefetch` blocks of `block_size` bytes are read (and
+    decompressed) into a bounded queue while the consumer processes the
+    current one. Decompression and file reads release the GIL, so
+    throughput approaches the slower of reading and processing rather
+    than their sum.
+    """
+
+    def __init__(self, base: IO[Any], prefetch: int=4,
+                 block_size: int=1024 * 1024) -> None:
+        self.base = base
+        self.raw = get_file_object(base)
+        self.prefetch = prefetch
+        self.block_size = block_size
+        self.name = getattr(base, 'name', None)
+        self.myfileobj = _ConsumedRawFile(self)
+
+        self._pos = base.tell()
+        self.raw_position = self.raw.tell()
+        self._start()
+
+    def _start(self) -> None:
+        self._buffer = b''
+        self._buffer_pos = 0
+        self._eof = False
+        self._stopped = False
+        self._queue = queue.Queue(self.prefetch)  # type: queue.Queue
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _stop(self) -> None:
+        self._stopped = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def _produce(self) -> None:
+        try:
+            while not self._stopped:
+                block = self.base.read(self.block_size)
+                self._queue.put((block, self.raw.tell()))
+                if len(block) == 0:
+                    break
+        except Exception as error:
+            self._queue.put((error, None))
+
+    def _fill(self) -> bool:
+        while self._buffer_pos >= len(self._buffer):
+            if self._eof:
+                return False
+
+            start = time.perf_counter()
+            block, raw_position = self._queue.get()
+            _prefetch_metrics.wait_seconds.inc(time.perf_counter() - start)
+            if isinstance(block, Exception):
+                self._eof = True
+                raise block
+
+            self._buffer = block
+            self._buffer_pos = 0
+            self.raw_position = raw_position
+            if len(block) == 0:
+                self._eof = True
+        return True
 
-    if ext == '.gz':
-        return gzip.open(path, 'rb')
+    def seekable(self) -> bool:
+        return self.base.seekable()
+
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop()
+            self.base.close()
+        super().close()
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset = self._pos + offset
+            whence = io.SEEK_SET
+
+        buffer_start = self._pos - self._buffer_pos
+        if whence == io.SEEK_SET and \
+                buffer_start <= offset <= buffer_start + len(self._buffer):
+            self._buffer_pos = offset - buffer_start
+            self._pos = offset
+            return self._pos
+
+        self._stop()
+        self._pos = self.base.seek(offset, whence)
+        self.raw_position = self.raw.tell()
+        self._start()
+        return self._pos
+
+
+def read_file(path: str, seekable: bool=False,
+              threads: Optional[int]=None,
+              prefetch: int=0,
+              save_index: bool=False) -> IO[Any]:
+    """Opens a file for binary reading, decompressing it if its magic
+    bytes match a registered codec.
+
+    With `seekable`, gzip files are opened with a checkpointed reader that
+    supports cheap random access (e.g. for BiReader), and with
+    `save_index` its checkpoint index is saved next to the file after a
+    full pass; other codecs only seek by decompressing again from the
+    start. Multi-member gzip files
+    written by `file_output` are decompressed by `threads` threads. With
+    `prefetch`, that many blocks are read ahead in a background thread.
+    """
+    codec = detect_codec(path)
+
+    if codec is None:
+        input_file = open(path, 'rb')
+    elif codec.name == 'gzip':
+        if seekable:
+            input_file = SeekableGzipFile(path, save_index=save_index)
+        elif threads != 1 and is_multi_member(path):
+            input_file = ParallelGzipReader(path, threads=threads)
+        else:
+            input_file = gzip.open(path, 'rb')
     else:
-        return open(path, 'rb')
+        input_file = open_codec(codec, open(path, 'rb'), 'rb',
+                                threads=threads)
+
+    if prefetch > 0:
+        return PrefetchReader(input_file, prefetch)
+    return input_file
+
+
+def _count_newlines(fd: int, start: int, end: int, block_size: int) -> int:
+    count = 0
+    while start < end:
+        data = os.pread(fd, min(block_size, end - start), start)
+        if len(data) == 0:
+            break
+        count += data.count(b'\n')
+        start += len(data)
+    return count
+
+
+def _count_gzip_newlines(path: str, threads: Optional[int],
+                         block_size: int) -> Tuple[int, bytes]:
+    count = 0
+    last = b''
+
+    if threads != 1 and is_multi_member(path):
+        with ParallelGzipReader(path, threads=threads) as input_file:
+            while True:
+                data = input_file.read1(block_size)
+                if len(data) == 0:
+                    break
+                count += data.count(b'\n')
+                last = data[-1:]
+        return count, last
+
+    with open(path, 'rb') as input_file:
+        decompressor = None
+        data = b''
+        while True:
+            if len(data) == 0:
+                data = input_file.read(block_size)
+                if len(data) == 0:
+                    break
+
+            if decompressor is None:
+                # Next member, possibly after zero padding.
+                data = data.lstrip(b'\x00')
+                if len(data) == 0:
+                    continue
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+            output = decompressor.decompress(data, block_size)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = None
+            else:
+                data = decompressor.unconsumed_tail
+
+            if len(output) > 0:
+                count += output.count(b'\n')
+                last = output[-1:]
+
+    return count, last
+
+
+def _count_stream_newlines(path: str, block_size: int) -> Tuple[int, bytes]:
+    count = 0
+    last = b''
+    with read_file(path) as input_file:
+        while True:
+            data = input_file.read(block_size)
+            if len(data) == 0:
+                break
+            count += data.count(b'\n')
+            last = data[-1:]
+    return count, last
+
+
+def count_lines(path: str,
+                threads: Optional[int]=None,
+                block_size: int=4 * 1024 * 1024) -> int:
+    """Counts lines exactly, the same way iterating over the file does
+    (an unterminated last line counts).
+
+    Plain files are scanned in large blocks with pread across `threads`
+    threads, gzip files are decompressed with raw zlib (or in parallel for
+    multi-member files), other compressed files are streamed.
+    """
+    cache = get_default_cache()
+    if cache is not None:
+        codec = detect_codec(path)
+        key = file_key(path) + ('plain' if codec is None else codec.name,)
+        count = cache.get(key, 'line_count')
+        if count is None:
+            count = _count_lines(path, threads, block_size)
+            cache.put(key, 'line_count', count)
+        return count
+
+    return _count_lines(path, threads, block_size)
+
+
+def _count_lines(path: str, threads: Optional[int], block_size: int) -> int:
+    codec = detect_codec(path)
+    if codec is not None:
+        if codec.name == 'gzip':
+            count, last = _count_gzip_newlines(path, threads, block_size)
+        else:
+            count, last = _count_stream_newlines(path, block_size)
+        return count + (1 if last not in (b'', b'\n') else 0)
+
+    threads = threads or os.cpu_count() or 1
+
+    with open(path, 'rb') as input_file:
+        fd = input_file.fileno()
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return 0
+
+        step = max(block_size,
+                   -(-size // (4 * threads * block_size)) * block_size)
+        ranges = [(start, min(start + step, size))
+                  for start in range(0, size, step)]
+
+        if threads == 1 or len(ranges) == 1:
+            count = _count_newlines(fd, 0, size, block_size)
+        else:
+            with ThreadPoolExecutor(threads) as executor:
+                count = sum(executor.map(
+                    lambda r: _count_newlines(fd, r[0], r[1], block_size),
+                    ranges))
+
+        last = os.pread(fd, 1, size - 1)
+
+    return count + (1 if last != b'\n' else 0)
+
+
+def line_aligned_ranges(path: str,
+                        chunk_size: int=16 * 1024 * 1024
+                        ) -> List[Tuple[int, int]]:
+    """Splits an uncompressed file into [start, end) byte ranges of about
+    `chunk_size` bytes, each starting at the beginning of a line."""
+    ranges = []  # type: List[Tuple[int, int]]
+
+    with open(path, 'rb') as input_file:
+        size = file_size(input_file)
+        start = 0
+
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                input_file.seek(end)
+                input_file.readline()
+                end = input_file.tell()
+
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+class PageCache(object):
+    """LRU cache of fixed-size, block-aligned file pages.
+
+    A single cache can be shared by several CachedStreams (and so several
+    BiReaders) over the same or different files; pages are keyed by file
+    identity and page index.
+    """
+
+    def __init__(self, capacity: int=64 * 1024 * 1024,
+                 page_size: int=4096) -> None:
+        self.capacity = capacity
+        self.page_size = page_size
+        self.pages = collections.OrderedDict()  # type: Dict[Any, bytes]
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[bytes]:
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.pages.move_to_end(key)
+            return page
+
+    def put(self, key: Any, page: bytes) -> None:
+        with self.lock:
+            if key in self.pages:
+                self.used -= len(self.pages.pop(key))
+            self.pages[key] = page
+            self.used += len(page)
+
+            while self.used > self.capacity and len(self.pages) > 1:
+                _, evicted = self.pages.popitem(last=False)
+                self.used -= len(evicted)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pages.clear()
+            self.used = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class CachedStream(io.RawIOBase):
+    """Seekable binary stream reading through a PageCache.
+
+    Misses read one page at a time while accesses jump around (e.g.
+    bisection); when pages are requested in order the read size doubles,
+    up to `max_readahead` pages, to serve sequential scans in large reads.
+    """
+
+    def __init__(self, base: IO[Any], cache: PageCache,
+                 max_readahead: int=64) -> None:
+        self.base = base
+        self.cache = cache
+        self.page_size = cache.page_size
+        self.max_readahead = max_readahead
+        self.size = file_size(base)
+
+        try:
+            identity = file_key(get_file_object(base).fileno())
+        except (AttributeError, OSError, ValueError):
+            identity = id(base)
+        self.identity = (identity, is_compressed(base))
+
+        self.pos = 0
+        self.last_index = -2
+        self.readahead = 1
+
+    def _page(self, index: int) -> bytes:
+        page = self.cache.get((self.identity, index))
+
+        if page is None:
+            if self.last_index <= index <= self.last_index + 1:
+                self.readahead = min(2 * self.readahead, self.max_readahead)
+            else:
+                self.readahead = 1
+
+            self.base.seek(index * self.page_size)
+            data = self.base.read(self.readahead * self.page_size)
+            for i in range(0, len(data), self.page_size):
+                self.cache.put((self.identity, index + i // self.page_size),
+                               data[i:i + self.page_size])
+            page = data[:self.page_size]
+
+        self.last_index = index
+        return page
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.pos
+
+        chunks = []
+        while size > 0 and self.pos < self.size:
+            index = self.pos // self.page_size
+            offset = self.pos - index * self.page_size
+            chunk = self._page(index)[offset:offset + size]
+            if len(chunk) == 0:
+                break
+
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset = self.pos + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.base.fileno()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.base.close()
+        super().close()
+
+
+_bireader_metrics = StreamMetrics('bireader')
 
 
 class BiReader(io.IOBase):
-    def __init__(self, base_stream, buffer_size=8196):
+    def __init__(self, base_stream, buffer_size=8196,
+                 page_cache: Optional[PageCache]=None):
+        if page_cache is not None:
+            base_stream = CachedStream(base_stream, page_cache)
+
         self.base_stream = base_stream
         self.size = file_size(base_stream)
         self.buffer_size = buffer_size
 
-        self.left = ""
+        # Works with both binary and text streams.
+        self.empty = base_stream.read(0)
+        self.newline = b'\n' if isinstance(self.empty, bytes) else '\n'
+
+        self.left = self.empty
         self.focus = 0
         self.center = 0
-        self.right = ""
+        self.right = self.empty
 
     def seek(self, offset, whence=io.SEEK_SET):
         if whence == io.SEEK_CUR:
@@ -240,10 +1029,11 @@ class BiReader(io.IOBase):
             self.focus = offset
         else:
             self.base_stream.seek(offset, whence)
+            _bireader_metrics.seeks.inc()
             self.focus = offset
 
-            self.right = ""
-            self.left = ""
+            self.right = self.empty
+            self.left = self.empty
             self.center = offset
 
     def tell(self):
@@ -269,12 +1059,17 @@ class BiReader(io.IOBase):
         if self.focus == self.size:
             return False
 
+        start = time.perf_counter()
         self.base_stream.seek(self.focus, 0)
 
         self.left = self.right if len(self.right) > 0 else self.left
         self.right = self.base_stream.read(self.buffer_size)
         self.center = self.focus
 
+        _bireader_metrics.seeks.inc()
+        _bireader_metrics.record_read(len(self.right), len(self.right), 0,
+                                      time.perf_counter() - start)
+
         return True
 
     def _move_left(self):
@@ -286,19 +1081,24 @@ class BiReader(io.IOBase):
         seek_pos = max(self.focus - self.buffer_size, 0)
         read_size = min(self.focus, self.buffer_size)
 
+        start = time.perf_counter()
         self.base_stream.seek(seek_pos, 0)
 
         self.right = self.left if len(self.left) > 0 else self.right
         self.left = self.base_stream.read(read_size)
         self.center = self.focus
 
+        _bireader_metrics.seeks.inc()
+        _bireader_metrics.record_read(len(self.left), len(self.left), 0,
+                                      time.perf_counter() - start)
+
         return True
 
     def readr(self, limit=-1):
         if limit == -1:
             limit = self.size - self.focus
 
-        result = ""
+        result = self.empty
 
         while limit > 0:
             buf, pos = self._position(bias=1)
@@ -322,7 +1122,7 @@ class BiReader(io.IOBase):
         if limit == -1:
             limit = self.size - self.focus
 
-        result = ""
+        result = self.empty
 
         while limit > 0:
             buf, pos = self._position(bias=1)
@@ -330,7 +1130,7 @@ class BiReader(io.IOBase):
             if buf == 1 and pos < len(self.right):
                 length = min(len(self.right) - pos, limit)
 
-                index = self.right.find('\n', pos)
+                index = self.right.find(self.newline, pos)
                 if index != -1:
                     length = min(length, index + 1 - pos)
 
@@ -342,7 +1142,7 @@ class BiReader(io.IOBase):
             elif buf == -1:
                 length = min(len(self.left) - pos, limit)
 
-                index = self.left.find('\n', pos)
+                index = self.left.find(self.newline, pos)
                 if index != -1:
                     length = min(length, index + 1 - pos)
 
@@ -362,7 +1162,7 @@ class BiReader(io.IOBase):
         if limit == -1:
             limit = self.focus
 
-        result = ""
+        result = self.empty
 
         while limit > 0:
             buf, pos = self._position(bias=-1)
@@ -386,7 +1186,7 @@ class BiReader(io.IOBase):
         if limit == -1:
             limit = self.focus
 
-        result = ""
+        result = self.empty
 
         while limit > 0:
             buf, pos = self._position(bias=-1)
@@ -395,10 +1195,10 @@ class BiReader(io.IOBase):
                 length = min(pos, limit)
 
                 index = 0
-                if len(result) == 0 and self.left[pos - 1] == '\n' and greedy:
-                    index = self.left.rfind('\n', 0, pos - 1)
+                if len(result) == 0 and self.left[pos - 1:pos] == self.newline and greedy:
+                    index = self.left.rfind(self.newline, 0, pos - 1)
                 else:
-                    index = self.left.rfind('\n', 0, pos)
+                    index = self.left.rfind(self.newline, 0, pos)
 
                 if index != -1:
                     length = min(length, pos - (index + 1))
@@ -412,10 +1212,10 @@ class BiReader(io.IOBase):
                 length = min(pos, limit)
 
                 index = 0
-                if len(result) == 0 and self.right[pos - 1] == '\n' and greedy:
-                    index = self.right.rfind('\n', 0, pos - 1)
+                if len(result) == 0 and self.right[pos - 1:pos] == self.newline and greedy:
+                    index = self.right.rfind(self.newline, 0, pos - 1)
                 else:
-                    index = self.right.rfind('\n', 0, pos)
+                    index = self.right.rfind(self.newline, 0, pos)
 
                 if index != -1:
                     length = min(length, pos - (index + 1))
@@ -439,38 +1239,324 @@ class BiReader(io.IOBase):
         return self.readliner(limit)
 
     def close(self):
-        self.base.close()
+        self.base_stream.close()
 
     @property
     def closed(self):
-        return self.base.closed
+        return self.base_stream.closed
 
     def fileno(self):
-        return self.base.fileno()
+        return self.base_stream.fileno()
 
     def flush(self):
-        self.base.flush()
+        self.base_stream.flush()
 
     def isatty(self):
-        return self.base.isatty
+        return self.base_stream.isatty
 
     def readable(self):
-        return self.base.readable
+        return self.base_stream.readable
 
     def writeable(self):
         return False
 
     def seekable(self):
-        return self.base.seekable
+        return self.base_stream.seekable
 
     def eof(self):
         return self.focus == self.size
 
 
+class MMapBiReader(io.IOBase):
+    """BiReader over a memory-mapped uncompressed binary file.
+
+    Scans in both directions run `find`/`rfind` directly on the mapping,
+    results are single slices of it (memoryviews with `zero_copy`).
+    """
+
+    def __init__(self, base_stream, zero_copy: bool=False):
+        self.base_stream = base_stream
+        self.size = file_size(base_stream)
+        self.zero_copy = zero_copy
+
+        self.empty = b''
+        self.newline = b'\n'
+
+        if self.size > 0:
+            self.map = mmap.mmap(base_stream.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        else:
+            self.map = b''
+        self.view = memoryview(self.map)
+        self.focus = 0
+
+    def _slice(self, start, end):
+        if self.zero_copy:
+            return self.view[start:end]
+        return self.map[start:end]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self.focus + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+
+        assert 0 <= offset <= self.size
+        self.focus = offset
+
+    def tell(self):
+        return self.focus
+
+    def readr(self, limit=-1):
+        start = self.focus
+        end = self.size if limit == -1 else min(self.size, start + limit)
+        self.focus = end
+        return self._slice(start, end)
+
+    def readliner(self, limit=-1):
+        start = self.focus
+        end = self.size if limit == -1 else min(self.size, start + limit)
+
+        index = self.map.find(self.newline, start, end)
+        if index != -1:
+            end = index + 1
+
+        self.focus = end
+        return self._slice(start, end)
+
+    def readl(self, limit=-1):
+        end = self.focus
+        start = 0 if limit == -1 else max(0, end - limit)
+        self.focus = start
+        return self._slice(start, end)
+
+    def readlinel(self, limit=-1, greedy=True):
+        end = self.focus
+        start = 0 if limit == -1 else max(0, end - limit)
+
+        if start == end:
+            return self._slice(start, end)
+
+        if greedy and self.map[end - 1:end] == self.newline:
+            index = self.map.rfind(self.newline, start, end - 1)
+        else:
+            index = self.map.rfind(self.newline, start, end)
+
+        if index != -1:
+            start = index + 1
+
+        self.focus = start
+        return self._slice(start, end)
+
+    def read(self, limit=-1):
+        return self.readr(limit)
+
+    def readline(self, limit=-1):
+        return self.readliner(limit)
+
+    def close(self):
+        self.view.release()
+        if self.size > 0:
+            self.map.close()
+        self.base_stream.close()
+
+    @property
+    def closed(self):
+        return self.base_stream.closed
+
+    def fileno(self):
+        return self.base_stream.fileno()
+
+    def isatty(self):
+        return False
+
+    def readable(self):
+        return True
+
+    def writeable(self):
+        return False
+
+    def seekable(self):
+        return True
+
+    def eof(self):
+        return self.focus == self.size
+
+
+def open_bireader(path: str, use_mmap: bool=True,
+                  page_cache: Optional[PageCache]=None) -> IO[Any]:
+    """Opens a bidirectional reader, memory-mapped for plain files unless
+    a page cache is given."""
+    input_file = read_file(path, seekable=True)
+    if use_mmap and page_cache is None and not is_compressed(input_file):
+        return MMapBiReader(input_file)
+    return BiReader(input_file, page_cache=page_cache)
+
+
+SEARCH_INDEX_VERSION = 2
+
+SearchIndex = namedlist(
+    'SearchIndex',
+    ['file_size',
+     'file_mtime',
+     'offsets',
+     'keys'])
+
+
+def search_index_path(path: str) -> str:
+    """Returns the path of the sidecar index file for `path`."""
+    return path + '.idx'
+
+
+class SearchIndexBuilder(object):
+    """Samples (key, offset) pairs from lines fed in file order.
+
+    A sample is taken at the first line, at the last line and whenever
+    either `every_lines` lines or `every_bytes` bytes have passed since
+    the previous sample.
+    """
+
+    def __init__(self, key_func: Callable[[Any], Any],
+                 every_lines: Optional[int]=None,
+                 every_bytes: Optional[int]=64 * 1024) -> None:
+        self.key_func = key_func
+        self.every_lines = every_lines
+        self.every_bytes = every_bytes
+
+        self.offsets = array('Q')
+        self.keys = []  # type: List[Any]
+
+        self.offset = 0
+        self.lines_since = 0
+        self.bytes_since = 0
+        self.last = None  # type: Optional[Tuple[int, Any]]
+
+    def add(self, line: AnyStr) -> None:
+        if len(self.offsets) == 0 or \
+                (self.every_lines is not None and
+                 self.lines_since >= self.every_lines) or \
+                (self.every_bytes is not None and
+                 self.bytes_since >= self.every_bytes):
+            self.offsets.append(self.offset)
+            self.keys.append(self.key_func(line))
+            self.lines_since = 0
+            self.bytes_since = 0
+            self.last = None
+        else:
+            self.last = (self.offset, line)
+
+        self.offset += len(line)
+        self.lines_since += 1
+        self.bytes_since += len(line)
+
+    def build(self, path: str) -> SearchIndex:
+        """Returns the index, stamped with the current size and mtime of
+        `path` (which has to be closed by then)."""
+        if self.last is not None:
+            self.offsets.append(self.last[0])
+            self.keys.append(self.key_func(self.last[1]))
+            self.last = None
+
+        stat = os.stat(path)
+        return SearchIndex(
+            file_size=stat.st_size,
+            file_mtime=stat.st_mtime_ns,
+            offsets=self.offsets,
+            keys=self.keys)
+
+
+def build_search_index(path: str,
+                       key_func: Callable[[Any], Any],
+                       every_lines: Optional[int]=None,
+                       every_bytes: Optional[int]=64 * 1024
+                       ) -> SearchIndex:
+    """Samples (key, offset) pairs from a file sorted by `key_func`."""
+    builder = SearchIndexBuilder(key_func, every_lines, every_bytes)
+    with read_file(path) as input_file:
+        for line in input_file:
+            builder.add(line)
+    return builder.build(path)
+
+
+def _encode_key(key: Any) -> Any:
+    if isinstance(key, bytes):
+        return {'bytes': key.decode('latin-1')}
+    if isinstance(key, tuple):
+        return [_encode_key(part) for part in key]
+    return key
+
+
+def _decode_key(value: Any) -> Any:
+    if isinstance(value, dict):
+        return value['bytes'].encode('latin-1')
+    if isinstance(value, list):
+        return tuple(_decode_key(part) for part in value)
+    return value
+
+
+def save_search_index(index: SearchIndex, index_path: str) -> None:
+    """Writes the index as JSON. Keys can be numbers, strings, bytes or
+    tuples of those; other keys raise TypeError."""
+    text = json.dumps({'version': SEARCH_INDEX_VERSION,
+                       'file_size': index.file_size,
+                       'file_mtime': index.file_mtime,
+                       'offsets': list(index.offsets),
+                       'keys': [_encode_key(key) for key in index.keys]})
+    with open(index_path, 'w') as output_file:
+        output_file.write(text)
+
+
+def load_search_index(path: str,
+                      key_func: Callable[[Any], Any],
+                      every_lines: Optional[int]=None,
+                      every_bytes: Optional[int]=64 * 1024,
+                      index_path: Optional[str]=None
+                      ) -> SearchIndex:
+    """Loads the sidecar index of `path`, rebuilding it when stale.
+
+    The index is considered stale when the size or the modification time
+    of `path` differs from the ones recorded in the index.
+    """
+    if index_path is None:
+        index_path = search_index_path(path)
+
+    stat = os.stat(path)
+    try:
+        with open(index_path) as input_file:
+            fields = json.load(input_file)
+        if fields['version'] == SEARCH_INDEX_VERSION and \
+                fields['file_size'] == stat.st_size and \
+                fields['file_mtime'] == stat.st_mtime_ns:
+            return SearchIndex(
+                file_size=fields['file_size'],
+                file_mtime=fields['file_mtime'],
+                offsets=array('Q', fields['offsets']),
+                keys=[_decode_key(key) for key in fields['keys']])
+    except (OSError, ValueError, TypeError, KeyError, OverflowError):
+        pass
+
+    index = build_search_index(path, key_func, every_lines, every_bytes)
+    try:
+        save_search_index(index, index_path)
+    except (OSError, TypeError, ValueError):
+        # Read-only location or keys JSON can't hold, the index is still
+        # usable in memory.
+        pass
+    return index
+
+
 class BiReaderSearch(object):
-    def __init__(self, reader, key_func):
+    def __init__(self, reader, key_func, index: Optional[SearchIndex]=None,
+                 key_to_number: Optional[Callable[[Any], float]]=None):
         self.reader = reader
         self.key_func = key_func
+        self.index = index
+        self.key_to_number = key_to_number
+
+        if index is not None and len(index.offsets) > 0:
+            self.first = (index.offsets[0], index.keys[0])
+            self.last = (index.offsets[-1], index.keys[-1])
+            return
 
         with SaveFilePos(self.reader):
             self.reader.seek(0, io.SEEK_SET)
@@ -513,18 +1599,68 @@ class BiReaderSearch(object):
             self.reader.seek(0, io.SEEK_END)
             return
 
+        if self.index is not None:
+            # keys[i - 1] < key <= keys[i], bisect the block in memory.
+            i = bisect.bisect_left(self.index.keys, key)
+            self._bisect_block(self.index.offsets[i - 1],
+                               self.index.offsets[i], key)
+            return
+
+        self._bisect(left, left_key, right, right_key, key)
+
+    def _bisect_block(self, start, end, key):
+        """Positions the reader at the first line with a key >= `key`,
+        given that the line at `start` has a smaller key and the line at
+        `end` does not. The block is read once and only the keys of the
+        lines probed by the bisection are computed."""
+        newline = self.reader.newline
+        self.reader.seek(start)
+        block = self.reader.read(end - start)
+        # Zero-copy readers return memoryviews, which can't be searched;
+        # key_func still gets lines of the reader's own type.
+        data = bytes(block) if isinstance(block, memoryview) else block
+
+        # Line starts within the block, block[left] < key <= block[right].
+        left, right = 0, len(data)
+        while True:
+            middle = (left + right) // 2
+            line_start = data.rfind(newline, 0, middle) + 1
+            if line_start <= left:
+                line_start = data.find(newline, middle, right) + 1
+                if line_start <= 0 or line_start >= right:
+                    break
+
+            line_end = data.find(newline, line_start)
+            line = block[line_start:] if line_end == -1 else \
+                block[line_start:line_end + 1]
+            if self.key_func(line) < key:
+                left = line_start
+            else:
+                right = line_start
+
+        self.reader.seek(start + right)
+
+    def _key_at(self, offset):
+        """Reads the key of the line containing `offset`."""
+        self.reader.seek(offset)
+        self.reader.readlinel(greedy=False)
+        return self._read_key()
+
+    def _bisect(self, left, left_key, right, right_key, key):
+        """Positions the reader at the first line with a key >= `key`.
+
+        Returns the last line found with a key < `key`.
+        """
         while True:
             assert left_key < key <= right_key
 
-            middle = (left + right) // 2
-            self.reader.seek(middle)
-            self.reader.readlinel(greedy=False)
-            middle = self.reader.tell()
+            middle, middle_key = self._key_at((left + right) // 2)
 
             if middle == left:
-                return self.linearr(key)
+                self.reader.seek(left)
+                self.linearr(key)
+                return left, left_key
 
-            middle_key = self.key_func(self.reader.readliner())
             if middle_key < key:
                 left = middle
                 left_key = middle_key
@@ -534,17 +1670,340 @@ class BiReaderSearch(object):
             else:
                 assert False, "Should be unreachable."
 
+    def interpolationr(self, key, scan_size: int=4096):
+        """Like binaryr, but guesses the position of `key` by linear
+        interpolation between the keys of the interval ends.
+
+        Keys are mapped to numbers with `key_to_number`. Without it the
+        keys have to be numbers themselves; other keys (e.g. bytes or
+        str) are searched with binaryr. Every guess is followed by a guard probe
+        a few expected interpolation errors (sqrt(lines) * line length)
+        past it, which on uniformly distributed keys usually brackets the
+        key in a couple of steps. When that fails to halve the interval,
+        the next step bisects, so it never does much worse than binaryr.
+        Intervals below `scan_size` bytes are scanned linearly.
+        """
+        if self.key_to_number is None and \
+                not isinstance(key, (int, float)):
+            return self.binaryr(key)
+
+        left, left_key = self.first
+        right, right_key = self.last
+
+        if not (left_key < key):
+            self.reader.seek(0, io.SEEK_SET)
+            return
+        elif not (key <= right_key):
+            self.reader.seek(0, io.SEEK_END)
+            return
+
+        to_number = self.key_to_number or (lambda k: k)
+        target = to_number(key)
+        bisection = False
+
+        while True:
+            assert left_key < key <= right_key
+
+            width = right - left
+            if width <= scan_size:
+                self.reader.seek(left)
+                return self.linearr(key)
+
+            middle = (left + right) // 2
+            guess = middle
+            if not bisection:
+                low, high = to_number(left_key), to_number(right_key)
+                if high > low:
+                    guess = left + int((target - low) / (high - low) * width)
+                    guess = min(max(guess, left + 1), right - 1)
+
+            position, position_key = self._key_at(guess)
+            if position == left and guess != middle:
+                # Landed in the line at `left`, try the middle instead.
+                guess = middle
+                position, position_key = self._key_at(guess)
+
+            if position == left:
+                self.reader.seek(left)
+                return self.linearr(key)
+
+            line_length = max(self.reader.tell() - position, 1)
+            guard = 3 * int(math.sqrt(width * line_length))
+
+            if position_key < key:
+                left, left_key = position, position_key
+                guess = position + guard
+            else:
+                right, right_key = position, position_key
+                guess = position - guard
+
+            if not bisection and left < guess < right:
+                position, position_key = self._key_at(guess)
+                if position > left:
+                    if position_key < key:
+                        left, left_key = position, position_key
+                    else:
+                        right, right_key = position, position_key
+
+            bisection = not bisection and right - left > width // 2
+
+    def lookup_many(self, keys: Iterable[Any],
+                    step: int=4096) -> Iterator[Tuple[Any, int]]:
+        """Yields (key, offset) with the offset of the first line with a
+        key >= `key`, for each key of an ascending sequence.
+
+        Each search gallops forward from the previous one, doubling the
+        `step` until it passes the key, then bisects the last interval, so
+        a batch of keys costs about one forward pass instead of a full
+        bisection per key. The reader is left at the yielded offset.
+        """
+        left, left_key = self.first
+        previous = None
+
+        for key in keys:
+            assert previous is None or previous <= key, \
+                "Keys must be sorted."
+            previous = key
+
+            if not (self.first[1] < key) or not (key <= self.last[1]) or \
+                    self.index is not None:
+                self.binaryr(key)
+                yield key, self.reader.tell()
+                continue
+
+            right, right_key = self.last
+            probe = step
+            while left + probe < right:
+                middle, middle_key = self._key_at(left + probe)
+                if middle_key >= key:
+                    right, right_key = middle, middle_key
+                    break
+                if middle > left:
+                    left, left_key = middle, middle_key
+                probe *= 2
+
+            left, left_key = self._bisect(left, left_key,
+                                          right, right_key, key)
+            yield key, self.reader.tell()
+
+    def iter_range(self, low: Any, high: Any) -> Iterator[Any]:
+        """Yields the lines with `low` <= key < `high`.
+
+        Seeks once and then streams lines until a key reaches `high`.
+        """
+        self.binaryr(low)
+
+        while not self.reader.eof():
+            position = self.reader.tell()
+            line = self.reader.readliner()
+            if self.key_func(line) >= high:
+                self.reader.seek(position)
+                return
+            yield line
+
+
+def _run_size(input_file: IO[bytes],
+              key_func: Optional[Callable[[bytes], Any]],
+              memory: int) -> int:
+    """Bytes of input whose sort takes about `memory` bytes.
+
+    Sorting a run holds the block and a list of its lines, each a bytes
+    object in a list slot, plus their keys, so the footprint is estimated
+    per line from the average line length and the key of the first line.
+    """
+    line_length = max(estimate_line_length(input_file), 1.0)
+    line_size = 2 * line_length + sys.getsizeof(b'') + 8
+    if key_func is not None:
+        with SaveFilePos(input_file):
+            input_file.seek(0)
+            line = input_file.readline()
+        if len(line) > 0:
+            line_size += sys.getsizeof(key_func(line)) + 8
+    return max(int(memory * line_length / line_size), 64 * 1024)
+
+
+def _sort_run(block: bytes, run_path: str,
+              key_func: Optional[Callable[[bytes], Any]]) -> int:
+    """Sorts the lines of `block` into the run file `run_path`."""
+    # Newlines are added in place, to hold a single list of lines.
+    lines = block.split(b'\n')
+    if len(lines[-1]) == 0:
+        lines.pop()
+    for i in range(len(lines)):
+        lines[i] += b'\n'
+    lines.sort(key=key_func)
+
+    with file_output(run_path, mode='wb', threads=1,
+                     compresslevel=1) as output_file:
+        output_file.writelines(lines)
+    return len(lines)
+
+
+def _merge_runs(run_paths: List[str], output_path: str,
+                key_func: Optional[Callable[[bytes], Any]],
+                meter: Optional[ProgressMeter]=None,
+                builder: Optional[SearchIndexBuilder]=None,
+                **kwargs: Any) -> None:
+    inputs = [read_file(run_path, threads=1) for run_path in run_paths]
+    try:
+        with file_output(output_path, mode='wb', **kwargs) as output_file:
+            lines = 0
+            for line in heapq.merge(*inputs, key=key_func):
+                output_file.write(line)
+                if builder is not None:
+                    builder.add(line)
+                lines += 1
+                if meter is not None and lines % 1000 == 0:
+                    meter.update(lines, lines)
+            if meter is not None:
+                meter.update(lines, lines)
+    finally:
+        for input_file in inputs:
+            input_file.close()
+
+
+def external_sort(input_path: str, output_path: str,
+                  key_func: Optional[Callable[[bytes], Any]]=None,
+                  memory_limit: int=512 * 1024 * 1024,
+                  workers: Optional[int]=None,
+                  fan_in: int=256,
+                  compress_runs: bool=True,
+                  index: bool=False,
+                  every_lines: Optional[int]=None,
+                  every_bytes: Optional[int]=64 * 1024,
+                  temp_dir: Optional[str]=None,
+                  label: Optional[str]='',
+                  hide=None,
+                  **kwargs: Any) -> Optional[SearchIndex]:
+    """Sorts the lines of a file too large for memory by `key_func`.
+
+    The input is cut into runs whose sort takes about `memory_limit /
+    workers` bytes (see `_run_size`), which are sorted in a process pool
+    and spilled to `temp_dir`, then
+    k-way merged into `output_path`, at most `fan_in` runs at a time.
+    `key_func` is applied to lines as bytes and has to be picklable when
+    `workers` is not 1. With `index`, the sparse search index of the output
+    is built during the final merge and saved next to it; it is also
+    returned. Extra keyword arguments are passed to `file_output`.
+    """
+    if label is not None and label == '':
+        label = input_path
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    run_dir = tempfile.mkdtemp(prefix='ux-sort-', dir=temp_dir)
+    run_ext = '.gz' if compress_runs else ''
+    try:
+        run_paths = []  # type: List[str]
+        total_lines = 0
+
+        executor = ProcessPoolExecutor(workers) if workers > 1 else None
+        try:
+            with read_file(input_path) as input_file:
+                run_size = _run_size(input_file, key_func,
+                                     memory_limit // workers)
+                counter = CountIO(input_file)
+                with ProgressMeter(counter.file_stats.underlying_file_size,
+                                   label='%s (runs)' % label,
+                                   hide=hide or label is None) as meter:
+                    pending = collections.deque()  # type: Deque[Any]
+                    while True:
+                        block = counter.readblock(run_size)
+                        if len(block) == 0:
+                            break
+
+                        run_path = os.path.join(
+                            run_dir, 'run-%06d%s' % (len(run_paths), run_ext))
+                        run_paths.append(run_path)
+                        if executor is None:
+                            total_lines += _sort_run(block, run_path,
+                                                     key_func)
+                        else:
+                            pending.append(executor.submit(
+                                _sort_run, block, run_path, key_func))
+                            # Bounds the number of blocks held in memory.
+                            while len(pending) >= workers:
+                                total_lines += pending.popleft().result()
+                        del block
+
+                        meter.update(counter.file_stats.compressed_read_count,
+                                     total_lines)
+
+                    while len(pending) > 0:
+                        total_lines += pending.popleft().result()
+                    meter.update(counter.file_stats.compressed_read_count,
+                                 total_lines)
+
+            # Intermediate passes, until a single merge is left.
+            generation = 0
+            while len(run_paths) > fan_in:
+                generation += 1
+                groups = [run_paths[i:i + fan_in]
+                          for i in range(0, len(run_paths), fan_in)]
+                merged_paths = [
+                    os.path.join(run_dir, 'merge-%d-%06d%s' % (
+                        generation, i, run_ext))
+                    for i in range(len(groups))]
+
+                if executor is None:
+                    for group, merged_path in zip(groups, merged_paths):
+                        _merge_runs(group, merged_path, key_func,
+                                    threads=1, compresslevel=1)
+                else:
+                    futures = [executor.submit(_merge_runs, group,
+                                               merged_path, key_func,
+                                               threads=1, compresslevel=1)
+                               for group, merged_path in zip(groups,
+                                                             merged_paths)]
+                    for future in futures:
+                        future.result()
+
+                for run_path in run_paths:
+                    os.remove(run_path)
+                run_paths = merged_paths
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        builder = SearchIndexBuilder(key_func or (lambda line: line),
+                                     every_lines, every_bytes) \
+            if index else None
+        with ProgressMeter(total_lines, label='%s (merge)' % label,
+                           unit='lines', total_lines=total_lines,
+                           hide=hide or label is None) as meter:
+            _merge_runs(run_paths, output_path, key_func, meter, builder,
+                        **kwargs)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    if builder is None:
+        return None
+
+    search_index = builder.build(output_path)
+    try:
+        save_search_index(search_index, search_index_path(output_path))
+    except (TypeError, ValueError):
+        # Keys JSON can't hold, the index is only returned.
+        pass
+    return search_index
+
 
+@cached_estimate('compression_ratio')
 def estimate_compression_ratio(input_file: IO[Any],
                                max_error: float=0.01,
                                probability: float=0.99,
                                buf_size: int=1 * 1024 * 1024,
                                bootstrap: int=16 * 1024 * 1024,
-                               reset_pos: bool=True
+                               reset_pos: bool=True,
+                               use_cache: bool=True
                                ) -> float:
-    if not isinstance(input_file, gzip.GzipFile):
+    if not is_compressed(input_file):
         return 1.0
 
+    if isinstance(input_file, SeekableGzipFile) and \
+            input_file.indexed_size is not None:
+        return input_file.compressed_size / max(input_file.indexed_size, 1)
+
     with SaveFilePos(input_file, reset_pos):
         input_file.seek(0)
 
@@ -556,37 +2015,143 @@ def estimate_compression_ratio(input_file: IO[Any],
 
         try:
             while True:
-                decompressed += len(input_file.read(buf_size))
+                chunk = len(input_file.read(buf_size))
+                if chunk == 0:
+                    # Most readers return b'' at the end of file.
+                    raise EOFError()
+                decompressed += chunk
                 compressed = input_file.myfileobj.tell() - initial_pos
                 ratio = compressed / decompressed
                 err = k * ratio * (1 - ratio) / decompressed
                 if err <= max_error and decompressed >= bootstrap:
                     return ratio
         except EOFError:
-            return compressed / decompressed
+            return compressed / decompressed if decompressed > 0 else 1.0
 
 
+@cached_estimate('file_size')
 def estimate_file_size(input_file: IO[Any],
                        max_error: float=0.01,
                        probability: float=0.99,
-                       reset_pos: bool=True
+                       reset_pos: bool=True,
+                       use_cache: bool=True
                        ) -> int:
     with SaveFilePos(input_file, reset_pos):
-        if isinstance(input_file, gzip.GzipFile):
-            size = file_size(input_file.myfileobj)
+        if isinstance(input_file, SeekableGzipFile) and \
+                input_file.indexed_size is not None:
+            return input_file.indexed_size
+        elif is_compressed(input_file):
+            size = underlying_file_size(input_file)
             ratio = estimate_compression_ratio(
-                input_file, max_error, probability, reset_pos=False)
+                input_file, max_error, probability, reset_pos=False,
+                use_cache=use_cache)
             return int(size / ratio)
         else:
             return file_size(input_file, reset_pos=False)
 
 
+def _count_all_newlines(input_file: IO[Any],
+                        block_size: int=1024 * 1024) -> int:
+    input_file.seek(0)
+    newlines = 0
+    while True:
+        block = input_file.read(block_size)
+        if len(block) == 0:
+            return newlines
+        newlines += block.count(b'\n')
+
+
+def sample_newline_density(input_file: IO[Any],
+                           max_error: float=0.01,
+                           probability: float=0.99,
+                           window: int=64 * 1024,
+                           min_windows: int=16,
+                           max_windows: int=4096,
+                           seed: Optional[int]=None,
+                           reset_pos: bool=True
+                           ) -> Optional[Tuple[int, int, int]]:
+    """Counts newlines in fixed-size windows at uniformly random offsets.
+
+    Windows wrap around the end of the file, so `newlines / sampled` is an
+    unbiased estimate of the newline density whatever the file size and
+    however line lengths drift along the file. Returns (newlines, sampled
+    bytes, file size), or None if the file has no cheap random access
+    (e.g. a gzip.GzipFile or a gzip file without a checkpoint index).
+
+    Offsets are drawn in batches and visited in increasing order, so on a
+    SeekableGzipFile windows falling into the same checkpoint interval
+    share their decompression.
+    """
+    if isinstance(input_file, SeekableGzipFile):
+        size = input_file.indexed_size
+    elif not is_compressed(input_file):
+        size = file_size(input_file)
+    else:
+        size = None
+
+    if size is None:
+        return None
+
+    with SaveFilePos(input_file, reset_pos):
+        if size <= window * min_windows:
+            return _count_all_newlines(input_file), size, size
+
+        rng = random.Random(seed)
+        k = 1 / math.sqrt(1 - probability)
+        windows = 0
+        newlines = 0
+        newlines_squared = 0
+
+        while windows < max_windows:
+            batch = min(max(windows, min_windows), max_windows - windows)
+            if (windows + batch) * window >= size:
+                # Sampling on would read more than the whole file.
+                return _count_all_newlines(input_file), size, size
+
+            for offset in sorted(rng.randrange(size) for _ in range(batch)):
+                input_file.seek(offset)
+                data = input_file.read(window)
+                if len(data) < window:
+                    input_file.seek(0)
+                    data += input_file.read(window - len(data))
+
+                count = data.count(b'\n')
+                newlines += count
+                newlines_squared += count * count
+            windows += batch
+
+            if newlines == 0:
+                continue
+
+            mean = newlines / windows
+            variance = max(newlines_squared / windows - mean * mean, 0)
+            if k * math.sqrt(variance / windows) <= max_error * mean:
+                break
+
+        return newlines, windows * window, size
+
+
+@cached_estimate('line_length')
 def estimate_line_length(input_file: IO[Any],
                          max_error: float=0.01,
                          probability: float=0.99,
                          bootstrap_lines: int=10000,
-                         reset_pos: bool=True
+                         reset_pos: bool=True,
+                         sampling: bool=False,
+                         use_cache: bool=True
                          ) -> float:
+    """Estimates the average line length, newline included.
+
+    With `sampling`, small windows at random offsets are read instead of
+    the beginning of the file (see `sample_newline_density`).
+    """
+    if sampling:
+        sample = sample_newline_density(input_file, max_error, probability,
+                                        reset_pos=reset_pos)
+        if sample is not None:
+            newlines, sampled, size = sample
+            return size if newlines == 0 else sampled / newlines
+
     with SaveFilePos(input_file, reset_pos):
         input_file.seek(0)
 
@@ -611,21 +2176,40 @@ def estimate_line_length(input_file: IO[Any],
         return 0 if stats.sum == 0 else stats.sum / stats.line_count
 
 
+@cached_estimate('line_count')
 def estimate_line_count(input_file: IO[Any],
                         max_error: float=0.01,
                         probability: float=0.99,
                         bootstrap_lines: int=10000,
-                        reset_pos: bool=True
+                        reset_pos: bool=True,
+                        sampling: bool=False,
+                        use_cache: bool=True
                         ) -> int:
+    if sampling:
+        sample = sample_newline_density(input_file, max_error, probability,
+                                        reset_pos=reset_pos)
+        if sample is not None:
+            newlines, sampled, size = sample
+            if sampled == 0:
+                return 0
+
+            # An unterminated last line counts, as when iterating.
+            with SaveFilePos(input_file, reset_pos):
+                input_file.seek(size - 1)
+                unterminated = input_file.read(1) != b'\n'
+            return int(size * newlines / sampled) + unterminated
+
     with SaveFilePos(input_file, reset_pos):
         input_file.seek(0)
 
         e0 = max_error / 2
         p0 = 1 - math.sqrt(1 - probability)
 
-        size = estimate_file_size(input_file, max_error=e0, probability=p0)
+        size = estimate_file_size(input_file, max_error=e0, probability=p0,
+                                  use_cache=use_cache)
         line_len = estimate_line_length(input_file, max_error=e0,
                                         probability=p0,
                                         bootstrap_lines=bootstrap_lines,
-                                        reset_pos=False)
+                                        reset_pos=False,
+                                        use_cache=use_cache)
         return int(size / line_len)
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+
+import io, os, sys
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Counter(object):
+    """A monotonic counter with fixed labels.
+
+    `inc` only touches a dictionary owned by the calling thread, so it
+    takes no lock; the per-thread values are summed on collection.
+    """
+
+    __slots__ = ['registry', 'key']
+
+    def __init__(self, registry: 'MetricsRegistry', key: MetricKey) -> None:
+        self.registry = registry
+        self.key = key
+
+    def inc(self, value: float=1) -> None:
+        counts = self.registry.counts()
+        counts[self.key] = counts.get(self.key, 0) + value
+
+    @property
+    def value(self) -> float:
+        return self.registry.collect().get(self.key, 0)
+
+
+class MetricsRegistry(object):
+    """Process-wide counters, exportable in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []  # type: List[Dict[MetricKey, float]]
+        self.help = {}  # type: Dict[str, str]
+
+    def counts(self) -> Dict[MetricKey, float]:
+        """The counter values of the calling thread."""
+        try:
+            return self.local.counts
+        except AttributeError:
+            counts = self.local.counts = {}  # type: Dict[MetricKey, float]
+            with self.lock:
+                self.shards.append(counts)
+            return counts
+
+    def counter(self, name: str, help: str='', **labels: str) -> Counter:
+        if help != '' or name not in self.help:
+            self.help[name] = help
+        return Counter(self, (name, tuple(sorted(labels.items()))))
+
+    def collect(self) -> Dict[MetricKey, float]:
+        with self.lock:
+            shards = list(self.shards)
+
+        result = {}  # type: Dict[MetricKey, float]
+        for shard in shards:
+            for key, value in list(shard.items()):
+                result[key] = result.get(key, 0) + value
+        return result
+
+    def reset(self) -> None:
+        with self.lock:
+            for shard in self.shards:
+                shard.clear()
+
+    def prometheus_text(self) -> str:
+        values = self.collect()
+
+        lines = []
+        for name in sorted(set(name for name, _ in values)):
+            if self.help.get(name, '') != '':
+                lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s counter' % name)
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                label_text = ','.join(
+                    '%s="%s"' % (label, _escape(label_value))
+                    for label, label_value in labels)
+                lines.append('%s%s %s' % (
+                    name, '{%s}' % label_text if labels else '',
+                    repr(float(value)) if isinstance(value, float)
+                    else value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the metrics atomically, e.g. for the node_exporter
+        textfile collector."""
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as output_file:
+            output_file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+    def serve(self, port: int=9464, host: str='127.0.0.1') -> HTTPServer:
+        """Serves the metrics over HTTP from a daemon thread. Call
+        `shutdown` on the returned server to stop it."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True,
+                                  name='ux-metrics')
+        thread.start()
+        return server
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+
+def counter(name: str, help: str='', **labels: str) -> Counter:
+    """Returns a counter of the process-wide registry."""
+    return registry.counter(name, help, **labels)
+
+
+def write_prometheus(path: str) -> None:
+    registry.write_prometheus(path)
+
+
+def serve(port: int=9464, host: str='127.0.0.1') -> HTTPServer:
+    return registry.serve(port, host)
+
+
+class StreamMetrics(object):
+    """The counters reported by one kind of stream (reader or writer)."""
+
+    def __init__(self, name: str) -> None:
+        self.read_bytes = counter(
+            'ux_read_bytes_total',
+            'Bytes read from the underlying file.', stream=name)
+        self.decompressed_bytes = counter(
+            'ux_decompressed_bytes_total',
+            'Bytes produced after decompression.', stream=name)
+        self.written_bytes = counter(
+            'ux_written_bytes_total',
+            'Bytes written to the underlying file.', stream=name)
+        self.read_calls = counter(
+            'ux_read_calls_total', 'Read calls.', stream=name)
+        self.seeks = counter(
+            'ux_seeks_total', 'Seeks of the underlying file.', stream=name)
+        self.lines = counter(
+            'ux_lines_total', 'Lines produced.', stream=name)
+        self.read_seconds = counter(
+            'ux_read_seconds_total',
+            'Time spent in read calls, decompression included.',
+            stream=name)
+        self.decompress_seconds = counter(
+            'ux_decompress_seconds_total',
+            'Time spent decompressing, summed over threads.', stream=name)
+        self.compress_seconds = counter(
+            'ux_compress_seconds_total',
+            'Time spent compressing, summed over threads.', stream=name)
+        self.wait_seconds = counter(
+            'ux_wait_seconds_total',
+            'Time spent waiting for background threads.', stream=name)
+
+    def record_read(self, read_bytes: int, decompressed_bytes: int,
+                    lines: int, seconds: float, calls: int=1) -> None:
+        """Counts `calls` read calls, with a single thread-local lookup."""
+        counts = registry.counts()
+        for metric, value in ((self.read_calls, calls),
+                              (self.read_bytes, read_bytes),
+                              (self.decompressed_bytes, decompressed_bytes),
+                              (self.lines, lines),
+                              (self.read_seconds, seconds)):
+            counts[metric.key] = counts.get(metric.key, 0) + value
@@ -4,34 +4,696 @@
 import io, os, sys
 
 import cProfile
+import collections
+import json
 import resource
 import pstats
+import threading
+import time
+import tracemalloc
 
 import easytime
 
+
+class StageStats(object):
+    """Aggregated timings of a stage, merged over repeated calls with the
+    same name under the same parent."""
+
+    __slots__ = ['name', 'count', 'total', 'min', 'max', 'samples',
+                 'peak_memory', 'counters', 'children']
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.samples = 0
+        self.peak_memory = None
+        self.counters = {}
+        self.children = {}
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = StageStats(name)
+        return node
+
+    def add(self, duration, counters=None, peak_memory=None):
+        self.count += 1
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        if peak_memory is not None:
+            self.peak_memory = peak_memory if self.peak_memory is None \
+                else max(self.peak_memory, peak_memory)
+        if counters:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """Adds the timings of `other` (and of its subtree) to this node."""
+        self.count += other.count
+        self.total += other.total
+        self.samples += other.samples
+        for attr, pick in (('min', min), ('max', max),
+                           ('peak_memory', max)):
+            value = getattr(other, attr)
+            if value is not None:
+                mine = getattr(self, attr)
+                setattr(self, attr, value if mine is None
+                        else pick(mine, value))
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, child in other.children.items():
+            self.child(name).merge(child)
+
+    @property
+    def self_time(self):
+        """Time not spent in child stages."""
+        return self.total - sum(child.total
+                                for child in self.children.values())
+
+    def to_dict(self):
+        derived = {}
+        if self.total > 0 and 'cpu_user' in self.counters:
+            derived['cpu_utilization'] = (self.counters['cpu_user'] +
+                                          self.counters['cpu_system']) / \
+                self.total
+            for name in ('read_chars', 'write_chars'):
+                if name in self.counters:
+                    derived[name + '_per_second'] = \
+                        self.counters[name] / self.total
+        return {
+            'name': self.name,
+            'count': self.count,
+            'total': self.total,
+            'self': self.self_time,
+            'min': self.min,
+            'max': self.max,
+            'samples': self.samples,
+            'peak_memory': self.peak_memory,
+            'counters': dict(self.counters),
+            'derived': derived,
+            'children': [child.to_dict()
+                         for child in self.children.values()],
+        }
+
+
+class StageTracker(object):
+    """Process-wide record of the profiled stages.
+
+    Every thread has its own tree of stages, rooted at a node named after
+    the thread. With `max_events`, the last that many completed stages are
+    also kept as trace events for `chrome_trace`; none are by default.
+    """
+
+    def __init__(self, max_events=0):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.roots = {}
+        self.stacks = {}
+        self.events = collections.deque(maxlen=max_events)
+        self.dropped_events = 0
+        self.origin = time.perf_counter()
+
+    def stack(self):
+        """The stages open in the current thread, outermost first."""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            # First use in this thread, or in a forked child.
+            thread = threading.current_thread()
+            root = StageStats(thread.name)
+            stack = [root]
+            with self.lock:
+                self.roots[(pid, thread.ident)] = root
+                self.stacks[(pid, thread.ident)] = stack
+            self.local.pid = pid
+            self.local.stack = stack
+        return self.local.stack
+
+    def thread_stack(self, thread_id):
+        """A copy of the stages open in another thread of this process."""
+        with self.lock:
+            stack = self.stacks.get((os.getpid(), thread_id))
+        return [] if stack is None else list(stack)
+
+    def enter(self, name):
+        stack = self.stack()
+        node = stack[-1].child(name)
+        stack.append(node)
+        return node
+
+    def exit(self, node, start, end, counters=None, peak_memory=None):
+        stack = self.stack()
+        if stack[-1] is node:
+            stack.pop()
+        elif node in stack:
+            # Stages were closed out of order.
+            del stack[stack.index(node):]
+        node.add(end - start, counters, peak_memory)
+
+        if self.events.maxlen == 0:
+            return
+
+        event = {
+            'name': node.name,
+            'ph': 'X',
+            'ts': (start - self.origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        }
+        if counters or peak_memory is not None:
+            event['args'] = dict(counters or {})
+            if peak_memory is not None:
+                event['args']['peak_memory'] = peak_memory
+
+        with self.lock:
+            if len(self.events) == self.events.maxlen:
+                # The oldest event makes room.
+                self.dropped_events += 1
+            self.events.append(event)
+
+    def record_events(self, max_events=100000):
+        """Keeps the last `max_events` completed stages as trace events
+        from now on; 0 stops recording and drops them."""
+        with self.lock:
+            self.events = collections.deque(self.events, maxlen=max_events)
+
+    def count(self, name, value=1):
+        """Adds `value` to a counter of the innermost open stage of the
+        current thread."""
+        node = self.stack()[-1]
+        node.counters[name] = node.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.roots = {}
+            self.stacks = {}
+            self.events = collections.deque(maxlen=self.events.maxlen)
+            self.dropped_events = 0
+        self.local = threading.local()
+
+    def chrome_trace(self):
+        """Trace-event JSON, loadable in Perfetto or about:tracing."""
+        with self.lock:
+            events = list(self.events)
+            roots = dict(self.roots)
+
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                     'tid': tid, 'args': {'name': root.name}}
+                    for (pid, tid), root in roots.items()]
+        return {'traceEvents': metadata + events,
+                'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """Stage trees per thread and merged over all the threads."""
+        with self.lock:
+            roots = dict(self.roots)
+
+        total = StageStats('total')
+        threads = []
+        for (pid, tid), root in sorted(roots.items()):
+            total.merge(root)
+            threads.append({'pid': pid, 'tid': tid, 'name': root.name,
+                            'stages': [child.to_dict() for child
+                                       in root.children.values()]})
+        return {'threads': threads,
+                'stages': [child.to_dict()
+                           for child in total.children.values()],
+                'dropped_events': self.dropped_events}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as output_file:
+            json.dump(self.chrome_trace(), output_file)
+
+    def write_summary(self, path):
+        with open(path, 'w') as output_file:
+            json.dump(self.summary(), output_file, indent=2)
+
+
+_tracker = StageTracker()
+
+
+def get_tracker():
+    return _tracker
+
+
+def count(name, value=1):
+    """Adds to a custom counter of the current stage."""
+    _tracker.count(name, value)
+
+
+def record_events(max_events=100000):
+    """Starts keeping stages as trace events for `write_chrome_trace`."""
+    _tracker.record_events(max_events)
+
+
+def write_chrome_trace(path):
+    _tracker.write_chrome_trace(path)
+
+
+def write_summary(path):
+    _tracker.write_summary(path)
+
+
+class Watcher(object):
+    """A background thread calling `callback` every `interval` seconds
+    while at least one user has started it."""
+
+    # Threads of all the watchers, not worth profiling.
+    idents = set()
+
+    def __init__(self, interval, name, callback):
+        self.interval = interval
+        self.name = name
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.users = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def _run(self):
+        Watcher.idents.add(threading.get_ident())
+        try:
+            while not self.stopped.wait(self.interval):
+                self.callback()
+        finally:
+            Watcher.idents.discard(threading.get_ident())
+
+    def start(self):
+        with self.lock:
+            self.users += 1
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True,
+                                           name=self.name)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0 or self.thread is None:
+                return
+            thread, self.thread = self.thread, None
+        self.stopped.set()
+        thread.join()
+
+
+class SamplingProfiler(Watcher):
+    """Samples the Python stacks of all the threads from a watcher thread.
+
+    Every `interval` seconds `sys._current_frames` is read and each stack
+    is recorded under the stages open in its thread at that moment, so
+    the overhead is independent of how many calls the profiled code
+    makes. Samples are kept as collapsed stacks for flame graphs (e.g.
+    flamegraph.pl or speedscope).
+    """
+
+    def __init__(self, tracker=None, interval=0.01):
+        super(SamplingProfiler, self).__init__(interval, 'ux-sampler',
+                                               self.sample)
+        self.tracker = _tracker if tracker is None else tracker
+        self.stacks = {}
+        self.stages = {}
+        self.labels = {}
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = '%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    def _frames(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return tuple(labels)
+
+    def sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in Watcher.idents:
+                continue
+
+            stages = self.tracker.thread_stack(thread_id)
+            frames = self._frames(frame)
+            for node in stages:
+                node.samples += 1
+
+            key = (tuple(node.name for node in stages), frames)
+            with self.lock:
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                for stage in self.stages.get(thread_id, ()):
+                    stage.samples[frames] = stage.samples.get(frames, 0) + 1
+
+    def attach(self, stage):
+        """Starts collecting samples of the current thread into
+        `stage.samples`."""
+        with self.lock:
+            self.stages.setdefault(threading.get_ident(), []).append(stage)
+        self.start()
+
+    def detach(self, stage):
+        self.stop()
+        with self.lock:
+            stages = self.stages.get(threading.get_ident(), [])
+            if stage in stages:
+                stages.remove(stage)
+
+    def collapsed(self):
+        """Lines of 'thread;stage;...;frame;... count'."""
+        with self.lock:
+            stacks = dict(self.stacks)
+        return ['%s %d' % (';'.join(stages + frames), samples)
+                for (stages, frames), samples in sorted(stacks.items())]
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as output_file:
+            for line in self.collapsed():
+                output_file.write(line + '\n')
+
+
+_sampler = None
+
+
+def get_sampler(interval=0.01):
+    """The process-wide sampler; `interval` applies when it is created."""
+    global _sampler
+    if _sampler is None:
+        _sampler = SamplingProfiler(_tracker, interval)
+    return _sampler
+
+
+def write_collapsed(path):
+    get_sampler().write_collapsed(path)
+
+
+def current_rss():
+    """Resident set size of this process in bytes.
+
+    Read from /proc/self/statm where available; elsewhere the lifetime
+    peak from getrusage is the best approximation.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Peak resident set size of this process over its lifetime, in
+    bytes (ru_maxrss is in kilobytes on Linux and in bytes on macOS)."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class MemoryWatcher(Watcher):
+    """Tracks the peak RSS of the attached stages by polling the current
+    RSS every `interval` seconds."""
+
+    def __init__(self, interval=0.01):
+        super(MemoryWatcher, self).__init__(interval, 'ux-memory',
+                                            self.sample)
+        self.stages = []
+
+    def sample(self):
+        rss = current_rss()
+        with self.lock:
+            for stage in self.stages:
+                stage.peak_memory = max(stage.peak_memory, rss)
+
+    def attach(self, stage):
+        with self.lock:
+            self.stages.append(stage)
+        self.start()
+
+    def detach(self, stage):
+        self.stop()
+        with self.lock:
+            if stage in self.stages:
+                self.stages.remove(stage)
+
+
+_memory_watcher = None
+
+
+def get_memory_watcher(interval=0.01):
+    global _memory_watcher
+    if _memory_watcher is None:
+        _memory_watcher = MemoryWatcher(interval)
+    return _memory_watcher
+
+
+def _read_high_water_mark():
+    """Peak RSS since the last reset, in bytes (VmHWM, Linux only)."""
+    with open('/proc/self/status', 'rb') as status:
+        for line in status:
+            if line.startswith(b'VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise ValueError('No VmHWM in /proc/self/status')
+
+
+class HighWaterMark(object):
+    """Tracks the peak RSS of the attached stages with the kernel's
+    high-water mark, which is reset when a stage starts.
+
+    The mark is process-wide, so before every reset its value is folded
+    into the peaks of all the stages still open. Unavailable outside
+    Linux, or where /proc/self/clear_refs isn't writable.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.available = True
+
+    def _fold(self):
+        peak = _read_high_water_mark()
+        for stage in self.stages:
+            stage.peak_memory = max(stage.peak_memory, peak)
+
+    def attach(self, stage):
+        """Returns False if the high-water mark is unavailable."""
+        with self.lock:
+            if not self.available:
+                return False
+            try:
+                self._fold()
+                with open('/proc/self/clear_refs', 'w') as clear_refs:
+                    clear_refs.write('5')
+            except (OSError, ValueError):
+                self.available = False
+                return False
+            self.stages.append(stage)
+            return True
+
+    def detach(self, stage):
+        with self.lock:
+            try:
+                self._fold()
+            except (OSError, ValueError):
+                pass
+            if stage in self.stages:
+                self.stages.remove(stage)
+
+
+_high_water_mark = HighWaterMark()
+
+
+def resource_usage(per_thread=False):
+    """CPU time, page faults, context switches and I/O of this process
+    (or of the calling thread, where the platform supports it).
+
+    I/O comes from /proc/self/io: `read_chars`/`write_chars` count all
+    the bytes passed to read/write calls, `read_bytes`/`write_bytes` only
+    those that reached the storage layer. It is missing outside Linux.
+    """
+    who = resource.RUSAGE_SELF
+    io_path = '/proc/self/io'
+    if per_thread and hasattr(resource, 'RUSAGE_THREAD'):
+        who = resource.RUSAGE_THREAD
+        io_path = '/proc/thread-self/io'
+
+    usage = resource.getrusage(who)
+    result = {
+        'cpu_user': usage.ru_utime,
+        'cpu_system': usage.ru_stime,
+        'minor_faults': usage.ru_minflt,
+        'major_faults': usage.ru_majflt,
+        'voluntary_switches': usage.ru_nvcsw,
+        'involuntary_switches': usage.ru_nivcsw,
+    }
+
+    try:
+        with open(io_path, 'rb') as proc_io:
+            fields = dict(line.split(b':', 1) for line in proc_io)
+        result['read_chars'] = int(fields[b'rchar'])
+        result['write_chars'] = int(fields[b'wchar'])
+        result['read_bytes'] = int(fields[b'read_bytes'])
+        result['write_bytes'] = int(fields[b'write_bytes'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return result
+
+
+def usage_delta(start, end):
+    return {name: end[name] - start[name] for name in end if name in start}
+
+
+def describe_usage(usage, wall):
+    """One-line summary of a `resource_usage` delta over `wall` seconds."""
+    wall = max(wall, 1e-9)
+    cpu = usage['cpu_user'] + usage['cpu_system']
+    parts = ['cpu %.0f%% (user %.2fs sys %.2fs)' % (
+        100.0 * cpu / wall, usage['cpu_user'], usage['cpu_system'])]
+
+    for direction, chars, disk in (('read', 'read_chars', 'read_bytes'),
+                                   ('write', 'write_chars', 'write_bytes')):
+        if chars in usage:
+            parts.append('%s %.1fMB %.1fMB/s (disk %.1fMB)' % (
+                direction, usage[chars] / 1048576.0,
+                usage[chars] / 1048576.0 / wall,
+                usage[disk] / 1048576.0))
+
+    parts.append('faults %d/%d' % (usage['major_faults'],
+                                   usage['minor_faults']))
+    parts.append('switches %d/%d' % (usage['voluntary_switches'],
+                                     usage['involuntary_switches']))
+    return ', '.join(parts)
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
 class profile_stage(object):
-    def __init__(self, name, detailed=False):
+    """Times a block of code as a stage of the current thread's tree.
+
+    Stages nest: a stage opened inside another is recorded as its child,
+    and stages repeated under the same parent are aggregated. Custom
+    counters can be attached with `count`. With `quiet`, the PROFILE line
+    is not printed.
+
+    `mode` selects a detailed profile of the stage: 'cprofile' (the same
+    as `detailed`) traces every call and is slow, 'sampling' samples the
+    stacks every `interval` seconds and is cheap enough to leave on. The
+    sampling report lists the `top` functions; with `output`, the stage's
+    samples are also written there as collapsed stacks.
+
+    Memory is the current RSS at the start and the end of the stage, and
+    its peak in between. The peak comes from the kernel's high-water mark
+    on Linux; elsewhere it is polled every `memory_interval` seconds by a
+    background thread, and left out (None) without one. With
+    `trace_allocations`, tracemalloc attributes the memory allocated and
+    not freed by the stage to the `top` source lines responsible.
+
+    CPU time, page faults, context switches and I/O bytes of the process
+    (of the thread with `per_thread`) are added to the stage counters,
+    and reported with the CPU utilization and the I/O throughput.
+    """
+
+    def __init__(self, name, detailed=False, quiet=False, tracker=None,
+                 mode=None, interval=0.01, top=20, output=None,
+                 memory_interval=None, trace_allocations=False,
+                 per_thread=False):
+        if mode is None and detailed:
+            mode = 'cprofile'
+        if mode not in (None, 'cprofile', 'sampling'):
+            raise ValueError('Unknown profiling mode: %r' % (mode,))
+
         self.name = name
-        self.detailed = detailed
+        self.mode = mode
+        self.detailed = mode == 'cprofile'
+        self.quiet = quiet
+        self.tracker = _tracker if tracker is None else tracker
+        self.interval = interval
+        self.top = top
+        self.output = output
+        self.memory_interval = memory_interval
+        self.trace_allocations = trace_allocations
+        self.per_thread = per_thread
+        self.counters = {}
+        self.samples = {}
 
     def report(self, message):
-        print("PROFILE[%s]: %s" % (message, self.name), file=sys.stderr)
+        if not self.quiet:
+            print("PROFILE[%s]: %s" % (message, self.name), file=sys.stderr)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
 
     @property
     def memusage(self):
-        usage = resource.getrusage(resource.RUSAGE_SELF)
-        return usage[2] * resource.getpagesize() / 1024.0 / 1024.0
+        """Current RSS in MB."""
+        return current_rss() / 1024.0 / 1024.0
 
     def __enter__(self):
         self.start = easytime.now()
-        self.start_memory = self.memusage
+        start_rss = current_rss()
+        self.start_memory = start_rss / 1024.0 / 1024.0
+        self.peak_memory = start_rss
+        if _high_water_mark.attach(self):
+            self.memory_watcher = _high_water_mark
+        elif self.memory_interval is not None:
+            self.memory_watcher = get_memory_watcher(self.memory_interval)
+            self.memory_watcher.attach(self)
+        else:
+            self.memory_watcher = None
+            self.peak_memory = None
+
+        if self.trace_allocations:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            self.snapshot = _take_snapshot()
+
+        self.node = self.tracker.enter(self.name)
+        self.start_usage = resource_usage(self.per_thread)
+        self.start_clock = time.perf_counter()
 
         if self.detailed:
             self.profiler = cProfile.Profile()
             self.profiler.enable()
+        elif self.mode == 'sampling':
+            get_sampler(self.interval).attach(self)
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.end_memory = self.memusage
+        if self.detailed:
+            self.profiler.disable()
+        elif self.mode == 'sampling':
+            get_sampler().detach(self)
+
+        if self.trace_allocations:
+            allocations = _take_snapshot().compare_to(self.snapshot,
+                                                      'lineno')
+            self.snapshot = None
+            if self.started_tracing:
+                tracemalloc.stop()
+
+        if self.memory_watcher is not None:
+            self.memory_watcher.detach(self)
+        end_rss = current_rss()
+        if self.peak_memory is not None:
+            self.peak_memory = max(self.peak_memory, end_rss)
+
+        self.end_clock = time.perf_counter()
+        self.usage = usage_delta(self.start_usage,
+                                 resource_usage(self.per_thread))
+        counters = dict(self.usage)
+        counters.update(self.counters)
+
+        self.tracker.exit(self.node, self.start_clock, self.end_clock,
+                          counters, self.peak_memory)
+        self.end_memory = end_rss / 1024.0 / 1024.0
 
         self.end = easytime.now()
         duration = int(self.end - self.start)
@@ -50,19 +712,65 @@ class profile_stage(object):
         else:
             time_str = '%.2fs' % (self.end - self.start,)
 
-        self.report("%s %.2fMB(%+.2fMB)" %
+        peak = '' if self.peak_memory is None else \
+            ', peak %.2fMB' % (self.peak_memory / 1024.0 / 1024.0)
+        self.report("%s %.2fMB(%+.2fMB%s) %s" %
                     (time_str, self.end_memory,
-                     self.end_memory - self.start_memory))
+                     self.end_memory - self.start_memory, peak,
+                     describe_usage(self.usage,
+                                    self.end_clock -
+                                    self.start_clock)))
+
+        if self.trace_allocations:
+            self.report(self.allocation_report(allocations))
 
         if self.detailed:
             if sys.version_info[0] == 3:
                 from io import StringIO
             else:
                 from cStringIO import StringIO
-            self.profiler.disable()
             s = StringIO()
             sortby = 'cumulative'
             ps = pstats.Stats(self.profiler, stream=s).sort_stats(sortby)
             ps.print_stats()
             self.report(s.getvalue())
             self.profiler = None
+        elif self.mode == 'sampling':
+            self.report(self.sampling_report())
+            if self.output is not None:
+                with open(self.output, 'w') as output_file:
+                    for frames, samples in sorted(self.samples.items()):
+                        output_file.write('%s %d\n' % (
+                            ';'.join((self.name,) + frames), samples))
+
+    def allocation_report(self, allocations):
+        net = sum(stat.size_diff for stat in allocations)
+        lines = ['%+.2fMB allocated' % (net / 1024.0 / 1024.0)]
+        allocations = sorted(allocations, key=lambda stat: -stat.size_diff)
+        for stat in allocations[:self.top]:
+            if stat.size_diff <= 0:
+                break
+            frame = stat.traceback[0]
+            lines.append('%+10.1fKB %8d blocks  %s:%d' % (
+                stat.size_diff / 1024.0, stat.count_diff,
+                frame.filename, frame.lineno))
+        return '\n'.join(lines)
+
+    def sampling_report(self):
+        total = sum(self.samples.values())
+        own = {}
+        cumulative = {}
+        for frames, samples in self.samples.items():
+            own[frames[-1]] = own.get(frames[-1], 0) + samples
+            for label in set(frames):
+                cumulative[label] = cumulative.get(label, 0) + samples
+
+        lines = ['%d samples every %.1fms' % (total, 1000 * self.interval),
+                 '   self    total  function']
+        ranked = sorted(cumulative, key=lambda label: (-own.get(label, 0),
+                                                       -cumulative[label]))
+        for label in ranked[:self.top]:
+            lines.append('%6.1f%%  %6.1f%%  %s' % (
+                100.0 * own.get(label, 0) / max(total, 1),
+                100.0 * cumulative[label] / max(total, 1), label))
+        return '\n'.join(lines)
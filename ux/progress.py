@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+
+import io, os, sys
+import time
+
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024 or unit == 'TB':
+            break
+        size /= 1024.0
+    return '%.1f%s' % (size, unit)
+
+
+def format_count(count: float) -> str:
+    for unit in ['', 'k', 'M', 'G']:
+        if abs(count) < 1000 or unit == 'G':
+            break
+        count /= 1000.0
+    return ('%d%s' if unit == '' else '%.1f%s') % (count, unit)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+class ProgressMeter(object):
+    """Progress reporting throttled by wall-clock time.
+
+    `update` only compares the clock against the next deadline, so it is
+    cheap enough to be called per batch or every few hundred lines. On a
+    terminal the bar is redrawn at most `rate` times per second; otherwise
+    a progress line is logged every `log_interval` seconds. Progress is
+    measured in `unit`s against `total` (typically compressed bytes
+    against the underlying file size, which is exact even for gzip).
+    """
+
+    def __init__(self, total: Optional[float],
+                 label: str='',
+                 unit: str='bytes',
+                 total_lines: Optional[int]=None,
+                 width: int=32,
+                 hide: Optional[bool]=None,
+                 rate: float=10.0,
+                 log_interval: float=30.0,
+                 stream: IO[str]=None) -> None:
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.total_lines = total_lines
+        self.width = width
+        self.stream = sys.stderr if stream is None else stream
+
+        isatty = getattr(self.stream, 'isatty', lambda: False)()
+        self.hidden = hide is True
+        self.interactive = isatty and not self.hidden
+        self.interval = 1.0 / rate if self.interactive else log_interval
+
+        self.start = time.monotonic()
+        self.deadline = self.start + self.interval
+        self.done = 0  # type: float
+        self.lines = 0
+
+    def update(self, done: float, lines: Optional[int]=None) -> None:
+        self.done = done
+        if lines is not None:
+            self.lines = lines
+
+        if self.hidden:
+            return
+
+        now = time.monotonic()
+        if now >= self.deadline:
+            self.deadline = now + self.interval
+            self.render(now)
+
+    def describe(self, now: float) -> str:
+        elapsed = max(now - self.start, 1e-9)
+        speed = self.done / elapsed
+
+        parts = []
+        if self.unit == 'bytes':
+            parts.append('%s/s' % format_size(speed))
+        else:
+            parts.append('%s %s/s' % (format_count(speed), self.unit))
+
+        if self.total_lines is not None:
+            parts.append('%s/%s lines' % (format_count(self.lines),
+                                          format_count(self.total_lines)))
+        else:
+            parts.append('%s lines' % format_count(self.lines))
+        if self.unit != 'lines':
+            parts.append('%s lines/s' % format_count(self.lines / elapsed))
+
+        if self.total is not None and speed > 0:
+            remaining = max(self.total - self.done, 0) / speed
+            parts.append('ETA %s' % format_duration(remaining))
+        else:
+            parts.append('elapsed %s' % format_duration(elapsed))
+
+        return ' '.join(parts)
+
+    def fraction(self) -> Optional[float]:
+        if self.total is None:
+            return None
+        if self.total <= 0:
+            return 1.0
+        return min(max(self.done / self.total, 0.0), 1.0)
+
+    def render(self, now: Optional[float]=None, final: bool=False) -> None:
+        if now is None:
+            now = time.monotonic()
+
+        fraction = self.fraction()
+        percent = '' if fraction is None else '%5.1f%% ' % (100 * fraction)
+
+        if self.interactive:
+            if fraction is None:
+                bar = ''
+            else:
+                filled = int(fraction * self.width)
+                bar = '[%s%s] ' % ('#' * filled, ' ' * (self.width - filled))
+            self.stream.write('\r%s %s%s%s\x1b[K' % (
+                self.label, bar, percent, self.describe(now)))
+            if final:
+                self.stream.write('\n')
+        else:
+            self.stream.write('%s: %s%s\n' % (
+                self.label, percent, self.describe(now)))
+        self.stream.flush()
+
+    def close(self) -> None:
+        if not self.hidden:
+            self.render(final=True)
+            self.hidden = True
+
+    def __enter__(self) -> 'ProgressMeter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
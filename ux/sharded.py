@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from typing import *
+
+import io, os, sys
+import glob
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from namedlist import namedlist
+
+from ux.io import (CountIO, estimate_file_size, estimate_line_count,
+                   read_file, split_lines)
+from ux.progress import ProgressMeter
+
+
+ShardEstimate = namedlist(
+    'ShardEstimate',
+    ['path',
+     'file_size',
+     'line_count'])
+
+
+def shard_paths(pattern: Union[str, Sequence[str]]) -> List[str]:
+    """Expands a glob pattern, a directory (all of its files) or a list of
+    paths into a sorted list of shard paths."""
+    if not isinstance(pattern, str):
+        return list(pattern)
+
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    return sorted(path for path in glob.glob(pattern)
+                  if os.path.isfile(path))
+
+
+class ShardedReader(object):
+    """Reads a set of (possibly compressed) shards as one stream of lines.
+
+    Progress is reported by a single meter against the total on-disk size
+    of the shards, which is exact even for gzip. With `readers` > 1, that
+    many shards are read and decompressed concurrently by worker threads
+    and their blocks are interleaved, so lines of different shards are
+    mixed; within a shard the order is preserved.
+
+        for line in ShardedReader('data/part-*.gz', label='data'):
+            ...
+    """
+
+    def __init__(self, pattern: Union[str, Sequence[str]],
+                 label: Optional[str]='',
+                 width: int=32, hide=None,
+                 codec: Optional[str]='utf-8',
+                 readers: int=1,
+                 threads: Optional[int]=None,
+                 block_size: int=1024 * 1024,
+                 queue_size: int=4,
+                 estimate_lines: bool=True) -> None:
+        self.paths = shard_paths(pattern)
+        self.label = pattern if label == '' and \
+            isinstance(pattern, str) else label
+        self.width = width
+        self.hide = hide is True or label is None
+        self.codec = codec
+        self.readers = readers
+        self.threads = threads
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.estimate_lines = estimate_lines
+
+        self.sizes = [os.path.getsize(path) for path in self.paths]
+        self.total_size = sum(self.sizes)
+
+        self.lock = threading.Lock()
+        self.bytes_done = 0
+        self.stopped = False
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _estimate_shard(self, path: str, max_error: float,
+                        probability: float) -> ShardEstimate:
+        with read_file(path, threads=1) as input_file:
+            return ShardEstimate(
+                path=path,
+                file_size=estimate_file_size(input_file, max_error,
+                                             probability),
+                line_count=estimate_line_count(input_file, max_error,
+                                               probability))
+
+    def estimates(self, max_error: float=0.01,
+                  probability: float=0.99) -> List[ShardEstimate]:
+        """Estimates the size and the line count of every shard, running
+        the estimators on `threads` shards at once.
+
+        The per-shard probability is raised so that all the estimates are
+        within `max_error` of the true values with `probability`, which
+        bounds the relative error of the totals as well.
+        """
+        if len(self.paths) == 0:
+            return []
+
+        shard_probability = 1 - (1 - probability) / len(self.paths)
+        with ThreadPoolExecutor(self.threads) as executor:
+            return list(executor.map(
+                lambda path: self._estimate_shard(path, max_error,
+                                                  shard_probability),
+                self.paths))
+
+    def estimate_file_size(self, max_error: float=0.01,
+                           probability: float=0.99) -> int:
+        return sum(estimate.file_size
+                   for estimate in self.estimates(max_error, probability))
+
+    def estimate_line_count(self, max_error: float=0.01,
+                            probability: float=0.99) -> int:
+        return sum(estimate.line_count
+                   for estimate in self.estimates(max_error, probability))
+
+    def _report(self, count: int) -> None:
+        with self.lock:
+            self.bytes_done += count
+
+    def _split(self, block: bytes) -> List[Any]:
+        if self.codec is None:
+            return split_lines(block)
+        return split_lines(block.decode(self.codec))
+
+    def _read_shard(self, path: str) -> Iterator[bytes]:
+        """Yields blocks of whole lines of a shard, reporting progress in
+        compressed bytes."""
+        threads = 1 if self.readers > 1 else self.threads
+        with read_file(path, threads=threads) as input_file:
+            counter = CountIO(input_file)
+            reported = 0
+            while not self.stopped:
+                block = counter.readblock(self.block_size)
+                read_count = counter.file_stats.compressed_read_count
+                self._report(read_count - reported)
+                reported = read_count
+                if len(block) == 0:
+                    break
+                yield block
+
+    def _sequential_blocks(self) -> Iterator[bytes]:
+        for path in self.paths:
+            yield from self._read_shard(path)
+
+    def _produce(self, shards: queue.Queue, blocks: queue.Queue) -> None:
+        result = None  # type: Any
+        try:
+            while not self.stopped:
+                try:
+                    path = shards.get_nowait()
+                except queue.Empty:
+                    break
+                for block in self._read_shard(path):
+                    self._put(blocks, block)
+        except Exception as error:
+            result = error
+        finally:
+            self._put(blocks, result)
+
+    def _put(self, blocks: queue.Queue, item: Any) -> None:
+        while not self.stopped:
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _parallel_blocks(self) -> Iterator[bytes]:
+        shards = queue.Queue()  # type: queue.Queue
+        for path in self.paths:
+            shards.put(path)
+
+        readers = min(self.readers, len(self.paths))
+        blocks = queue.Queue(self.queue_size * readers)  # type: queue.Queue
+        workers = [threading.Thread(target=self._produce,
+                                    args=(shards, blocks), daemon=True)
+                   for _ in range(readers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            running = len(workers)
+            while running > 0:
+                block = blocks.get()
+                if block is None:
+                    running -= 1
+                    continue
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+        finally:
+            self.stopped = True
+            for worker in workers:
+                worker.join()
+
+    def batches(self) -> Iterator[List[Any]]:
+        """Yields the lines of all the shards, one list per block."""
+        self.bytes_done = 0
+        self.stopped = False
+
+        if self.readers > 1:
+            blocks = self._parallel_blocks()
+        else:
+            blocks = self._sequential_blocks()
+
+        total_lines = self.estimate_line_count() \
+            if self.estimate_lines and not self.hide else None
+
+        with ProgressMeter(self.total_size, label=self.label,
+                           total_lines=total_lines, width=self.width,
+                           hide=self.hide) as meter:
+            lines = 0
+            try:
+                for block in blocks:
+                    batch = self._split(block)
+                    lines += len(batch)
+                    meter.update(self.bytes_done, lines)
+                    yield batch
+            finally:
+                blocks.close()
+            meter.update(self.bytes_done, lines)
+
+    def __iter__(self) -> Iterator[Any]:
+        for batch in self.batches():
+            yield from batch